@@ -9,6 +9,8 @@ from dash import dcc, html, Input, Output, dash_table
 from expenses.view.view import View
 from expenses.model.model import Model
 from expenses.controller.controller import Controller
+from expenses.metrics import configure_profiling, register_metrics
+from expenses.llm import DEFAULT_MODEL
 
 
 def main():
@@ -33,6 +35,56 @@ def main():
     )
 
     parser.add_argument('--debug', action='store_true', help='Enable debug mode')
+    parser.add_argument(
+        '--rebuild-cache',
+        action='store_true',
+        help='Discard the parsed sidecar files and classification cache in <csv-dir>/.cache and rebuild them'
+    )
+    parser.add_argument(
+        '--profile-dir',
+        type=str,
+        help='Profile every callback with cProfile and dump the stats of slow ones into this directory'
+    )
+    parser.add_argument(
+        '--profile-threshold-ms',
+        type=float,
+        default=500,
+        help='Only dump profiles of callbacks slower than this many milliseconds (default: 500)'
+    )
+
+    parser.add_argument(
+        '--max-memory-mb',
+        type=float,
+        help='Keep only recently used files in memory, about this many MB, and parse others again when needed'
+    )
+    parser.add_argument(
+        '--llm',
+        action='store_true',
+        help='Ask an LLM about transactions no keyword matches, implied by --llm-url'
+    )
+    parser.add_argument(
+        '--llm-url',
+        type=str,
+        help='Chat completions compatible endpoint, e.g. http://127.0.0.1:8001/v1 (default: the OpenAI API)'
+    )
+    parser.add_argument(
+        '--llm-model',
+        type=str,
+        default=DEFAULT_MODEL,
+        help=f'Model the LLM fallback asks (default: {DEFAULT_MODEL})'
+    )
+    parser.add_argument(
+        '--watch-interval',
+        type=float,
+        default=2.0,
+        help='Seconds between checks for CSVs added, changed or removed by other programs and for edits of the '
+             'category rules, 0 to not watch (default: 2)'
+    )
+    parser.add_argument(
+        '--shared',
+        action='store_true',
+        help='Pick up files written by other processes serving the same --csv-dir, see wsgi.py'
+    )
 
     args = parser.parse_args()
 
@@ -43,15 +95,45 @@ def main():
         print(f"CSV directory '{args.csv_dir}' exists but is not a directory.", file=sys.stderr)
         sys.exit(1)
 
-    model = Model(args.csv_dir)
+    app = create_app(args.csv_dir, rebuild_cache=args.rebuild_cache, llm=llm_options(args),
+                     max_memory_mb=args.max_memory_mb, shared=args.shared, watch_interval=args.watch_interval,
+                     profile_dir=args.profile_dir, profile_threshold_ms=args.profile_threshold_ms)
+    app.run(debug=args.debug, host=args.host, port=args.port)
+
+
+def llm_options(args):
+    """LLMClassifier options of the --llm flags, None without the fallback"""
+    return {'base_url': args.llm_url, 'model': args.llm_model} if args.llm or args.llm_url else None
+
 
-    app = dash.Dash(__name__)
+def create_app(csv_dir, rebuild_cache=False, llm=None, max_memory_mb=None, shared=False, watch_interval=2.0,
+               profile_dir=None, profile_threshold_ms=500):
+    """Build the Dash app serving csv_dir, see wsgi.py for running it in several processes"""
+    if profile_dir:
+        configure_profiling(profile_dir, profile_threshold_ms)
+
+    # Only lists the files, each is parsed when its tab is first opened
+    model = Model(csv_dir, rebuild_cache=rebuild_cache, llm=llm, max_memory_mb=max_memory_mb, shared=shared)
+    model.warm_up()
+    if watch_interval:
+        # Exports the sync job drops into csv_dir show up without a restart
+        model.watch(watch_interval)
+
+    app = dash.Dash(__name__, suppress_callback_exceptions=True)
+    # Prometheus metrics of load stages, classification and callbacks on /metrics
+    register_metrics(app.server)
+    if shared:
+        @app.server.before_request
+        def sync():
+            # Files other workers wrote since the last request, one small read if there are none
+            model.sync()
     view = View(model)
 
-    app.layout = view.main()
+    # A function, so that every page load lists the files in their current order
+    app.layout = view.main
     controller = Controller(app, model, view)
+    return app
 
-    app.run(debug=args.debug, host=args.host, port=args.port)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,105 @@
+"""Generator for synthetic German bank exports.
+
+The files look like the exports the dashboard reads: a 4-line preamble, a
+semicolon separated header, '%d.%m.%y' dates, '1.234,56' amounts and a few
+'Ausgleich' rows per month.
+"""
+import argparse
+import calendar
+import os
+import random
+
+
+HEADER = [
+    'Buchungsdatum', 'Wertstellung', 'Status', 'Zahlungspflichtige*r', 'Zahlungsempfänger*in',
+    'Verwendungszweck', 'Umsatztyp', 'IBAN', 'Betrag (€)', 'Gläubiger-ID', 'Mandatsreferenz',
+    'Kundenreferenz',
+]
+
+EXPENSES = [
+    ('REWE Markt GmbH', 'Einkauf REWE {n}'),
+    ('EDEKA Center', 'EDEKA SAGT DANKE {n}'),
+    ('ALDI SUED', 'Kartenzahlung ALDI {n}'),
+    ('Hausverwaltung Meier', 'Miete Wohnung {month}'),
+    ('Telekom Deutschland GmbH', 'Rechnung Internet {n}'),
+    ('Stadtwerke', 'Abschlag Strom {month}'),
+    ('Shell Tankstelle', 'Tanken {n}'),
+    ('AMAZON EU S.A R.L.', 'Bestellung {n}'),
+    ('Restaurant Da Mario', 'Kartenzahlung {n}'),
+    ('Unbekannter Haendler', 'Lastschrift {n}'),
+]
+
+INCOME = [
+    ('Arbeitgeber GmbH', 'Gehalt {month}'),
+    ('Finanzamt', 'Steuererstattung {n}'),
+    ('Max Mustermann', 'Ausgleich Einkauf {n}'),
+]
+
+
+def format_amount(value):
+    """Format a float the German way, e.g. -1234.5 -> '-1.234,50'"""
+    return f"{value:,.2f}".replace(',', 'X').replace('.', ',').replace('X', '.')
+
+
+def generate_rows(rows, year, month, rng):
+    days = calendar.monthrange(year, month)[1]
+    for n in range(rows):
+        day = rng.randint(1, days)
+        date = f"{day:02d}.{month:02d}.{year % 100:02d}"
+        if rng.random() < 0.15:
+            payer, purpose = rng.choice(INCOME)
+            payee = 'Konto Inhaber'
+            amount = round(rng.uniform(10, 4000), 2)
+        else:
+            payee, purpose = rng.choice(EXPENSES)
+            payer = 'Konto Inhaber'
+            amount = -round(rng.lognormvariate(3.5, 1.2), 2)
+        purpose = purpose.format(n=rng.randint(1000, 99999), month=f"{month:02d}/{year}")
+        iban = f"DE{rng.randint(10, 99)}{rng.randint(10 ** 17, 10 ** 18 - 1)}"
+        yield [
+            date, date, 'Gebucht', payer, payee, purpose,
+            'Eingang' if amount > 0 else 'Ausgang', iban, format_amount(amount), '', '', '',
+        ]
+
+
+def generate_file(path, rows, year=2024, month=1, seed=0, preamble=True):
+    """Write one synthetic export with the given number of transactions"""
+    rng = random.Random(seed)
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        if preamble:
+            f.write('"Girokonto";"DE00 1234 5678 9012 3456 78"\n')
+            f.write(f'"Zeitraum:";"01.{month:02d}.{year} - {calendar.monthrange(year, month)[1]}.{month:02d}.{year}"\n')
+            f.write(f'"Kontostand vom {calendar.monthrange(year, month)[1]}.{month:02d}.{year}:";"{format_amount(rng.uniform(0, 20000))} €"\n')
+            f.write('""\n')
+        f.write(';'.join(f'"{column}"' for column in HEADER) + '\n')
+        for row in generate_rows(rows, year, month, rng):
+            f.write(';'.join(f'"{value}"' for value in row) + '\n')
+    return path
+
+
+def generate_dir(directory, files, rows, start_year=2020, seed=0, preamble=True):
+    """Write one export per month, starting in January of start_year, returns the paths"""
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for k in range(files):
+        year, month = start_year + k // 12, k % 12 + 1
+        path = os.path.join(directory, f"{year}_{calendar.month_name[month]}_export.csv")
+        paths.append(generate_file(path, rows, year, month, seed=seed + k, preamble=preamble))
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic German bank exports.")
+    parser.add_argument("output_dir", help="Directory to write the CSV files to")
+    parser.add_argument("--files", type=int, default=12, help="Number of monthly files (default: 12)")
+    parser.add_argument("--rows", type=int, default=1000, help="Transactions per file (default: 1000)")
+    parser.add_argument("--start-year", type=int, default=2020, help="Year of the first file (default: 2020)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default: 0)")
+    parser.add_argument("--no-preamble", action='store_true', help="Leave out the 4-line account preamble")
+    args = parser.parse_args()
+    paths = generate_dir(args.output_dir, args.files, args.rows, args.start_year, args.seed, not args.no_preamble)
+    print(f"Wrote {len(paths)} files with {args.rows} rows each to {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
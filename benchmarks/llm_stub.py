@@ -0,0 +1,104 @@
+"""Stub chat-completions endpoint for the LLM fallback, no model and no network needed.
+
+Answers every prompt of expenses.llm with a category picked from the offered list by a
+hash of each text, optionally after some latency and failing a share of the requests:
+
+    python benchmarks/llm_stub.py --port 8001 --latency-ms 200 --failure-rate 0.1
+    python app.py --csv-dir data --llm-url http://127.0.0.1:8001/v1
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+    failure_rate = 0.0
+    requests = 0
+    texts = 0
+    _lock = threading.Lock()
+
+    def do_POST(self):
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self.send_error(404)
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        time.sleep(self.latency)
+        if random.random() < self.failure_rate:
+            self.send_error(503, "Stub failure")
+            return
+        messages = {message['role']: message['content'] for message in body['messages']}
+        texts = json.loads(messages['user'])
+        with StubHandler._lock:
+            StubHandler.requests += 1
+            StubHandler.texts += len(texts)
+        answer = {key: pick(text, categories(messages['system'])) for key, text in texts.items()}
+        self._reply({
+            'id': f"stub-{StubHandler.requests}",
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'stub'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': json.dumps(answer, ensure_ascii=False)},
+                'finish_reason': 'stop',
+            }],
+            'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0},
+        })
+
+    def _reply(self, payload):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def categories(system_prompt):
+    """The category names listed in the system prompt"""
+    match = re.search(r'categories: (.*?)\. ', system_prompt)
+    return match.group(1).split(', ') if match else ['sonstiges']
+
+
+def pick(text, names):
+    """Same category for the same text on every run"""
+    return names[int(hashlib.md5(text.encode('utf-8')).hexdigest(), 16) % len(names)]
+
+
+def serve(host='127.0.0.1', port=8001, latency_ms=0, failure_rate=0.0):
+    """Start the stub in a background thread, returns the server, stop it with shutdown()"""
+    StubHandler.latency = latency_ms / 1000
+    StubHandler.failure_rate = failure_rate
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency-ms', type=float, default=0, help='Delay of every response')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Share of requests answered with 503')
+    args = parser.parse_args()
+    server = serve(args.host, args.port, args.latency_ms, args.failure_rate)
+    print(f"Serving http://{args.host}:{server.server_port}/v1/chat/completions")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print(f"{StubHandler.requests} requests, {StubHandler.texts} texts")
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
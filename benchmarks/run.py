@@ -0,0 +1,277 @@
+"""Benchmarks of the ingest, classification, aggregation, rendering and upload paths.
+
+Run from anywhere, results are written as JSON and compared against a stored baseline:
+
+    python benchmarks/run.py --sizes small medium --output benchmarks/results/latest.json
+    python benchmarks/run.py --save-baseline benchmarks/results/baseline.json
+    python benchmarks/run.py --baseline benchmarks/results/baseline.json --threshold 0.2
+
+Every size also runs a crash scenario, see check_recovery, and fails if the totals are off.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# Model reads config/categories.yaml relative to the working directory
+os.chdir(ROOT)
+
+import pandas as pd
+
+from generate import generate_dir
+from expenses.model.model import Model
+from expenses.model import schema
+from expenses.model.index import FileIndex
+from expenses.view.view import View
+
+
+# (files, rows per file)
+SIZES = {
+    'small': (12, 500),
+    'medium': (36, 2000),
+    'large': (120, 5000),
+}
+
+
+def measure(fn, repeat, setup=None):
+    """Run fn repeat times and return min and median wall time in seconds"""
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return {'min': min(timings), 'median': statistics.median(timings), 'repeat': repeat}
+
+
+def prepare(workdir, files, rows):
+    """Generate raw exports and classify them into the directory the dashboard reads"""
+    raw_dir = os.path.join(workdir, 'raw')
+    csv_dir = os.path.join(workdir, 'data')
+    os.makedirs(csv_dir)
+    raw_files = generate_dir(raw_dir, files, rows)
+    model = Model(csv_dir)
+    for raw_file in raw_files:
+        name = os.path.basename(raw_file).replace('_export', '_classified')
+        model.classifier.classify_file(raw_file, os.path.join(csv_dir, name))
+    return raw_files, csv_dir
+
+
+# Adds the entries given as JSON and is killed while compacting them, after they were appended
+# to the CSV but before the journal is emptied
+CRASH_SCRIPT = """
+import json, os, sys
+sys.path.insert(0, sys.argv[1])
+from expenses.model.model import Model
+model = Model(sys.argv[2])
+for entry in json.loads(sys.argv[4]):
+    model.add_entry(sys.argv[3], entry)
+model._truncate_journal = lambda: os._exit(3)
+model.compact()
+"""
+
+
+def check_recovery(csv_dir):
+    """Crash in the middle of compacting a new booking and one another file has, then restart
+
+    The restarted model has to count the new booking once and the other one not at all,
+    the directory's sidecars and fingerprints both kept and rebuilt. Returns the seconds the
+    restart took and the problems found.
+    """
+    model = Model(csv_dir)
+    before = model.totals('MS').sum()
+    target, other = model.csv_files[0], model.csv_files[-1]
+    rows = len(model.data[target])
+    # A booking of the other file entered again, its fingerprint belongs to that file
+    booking = model.data[other].iloc[0]
+    duplicate = {
+        'Buchungsdatum': booking['Buchungsdatum'].strftime(schema.DATE_FORMAT),
+        'Betrag (€)': schema.format_cents([booking['Betrag (€)']])[0],
+        'IBAN': booking['IBAN'],
+        'Verwendungszweck': booking['Verwendungszweck'],
+        'Kategorie': booking['Kategorie'],
+    }
+    duplicate = {column: value for column, value in duplicate.items() if pd.notnull(value)}
+    new = {'Buchungsdatum': '15.06.21', 'Verwendungszweck': 'Crash', 'Betrag (€)': '-12,50', 'Kategorie': 'sonstiges'}
+    child = subprocess.run([sys.executable, '-c', CRASH_SCRIPT, ROOT, csv_dir, target, json.dumps([new, duplicate])],
+                           stdout=subprocess.DEVNULL)
+    problems = [] if child.returncode == 3 else [f"the crashing process exited with {child.returncode}"]
+    expected = before + pd.Series({'Income': 0, 'Expense': 1250})
+    start = time.perf_counter()
+    restarted = Model(csv_dir)
+    seconds = time.perf_counter() - start
+    for label, model in [('restart', restarted), ('rebuilt cache', Model(csv_dir, rebuild_cache=True))]:
+        totals = model.totals('MS').sum()
+        if not totals.equals(expected):
+            problems.append(f"{label}: totals {totals.to_dict()} instead of {expected.to_dict()}")
+        if len(model.data[target]) != rows + 2:
+            problems.append(f"{label}: {len(model.data[target]) - rows} rows added instead of 2")
+    return seconds, problems
+
+
+def check_saved_edit(csv_dir):
+    """Change a category and an amount in memory and save, then rebuild the sidecars
+
+    The rebuilt model has to read the edits from the CSV. Returns the seconds save() took
+    and the problems found.
+    """
+    model = Model(csv_dir)
+    csv_file = model.csv_files[0]
+    row = len(model.data[csv_file]) // 2
+    schema.assign(model.data[csv_file], 'Kategorie', [row], ['benchmark'])
+    schema.assign(model.data[csv_file], 'Betrag (€)', [row], [-4321])
+    model.update_index(csv_file)
+    start = time.perf_counter()
+    model.save()
+    seconds = time.perf_counter() - start
+    rebuilt = Model(csv_dir, rebuild_cache=True).data[csv_file].iloc[row]
+    problems = [f"rebuilt cache: {column} is {rebuilt[column]} instead of {value}"
+                for column, value in [('Kategorie', 'benchmark'), ('Betrag (€)', -4321)] if rebuilt[column] != value]
+    return seconds, problems
+
+
+def run_size(name, files, rows, repeat):
+    workdir = tempfile.mkdtemp(prefix=f'expenses-bench-{name}-')
+    try:
+        raw_files, csv_dir = prepare(workdir, files, rows)
+        model = Model(csv_dir, rebuild_cache=True)
+        model.load_all()
+        view = View(model)
+        csv_file = model.csv_files[-1]
+        raw_frame = pd.read_csv(raw_files[-1], delimiter=';', skiprows=4, dtype=str)
+        with open(raw_files[0], 'rb') as f:
+            upload = f.read()
+        upload_path = os.path.join(csv_dir, 'upload_benchmark_classified.csv')
+
+        def remove_upload():
+            if os.path.exists(upload_path):
+                os.remove(upload_path)
+                model.refresh_data()
+
+        def drop_ledger():
+            model._ledger = None
+
+        entry = {'Buchungsdatum': '15.06.21', 'Verwendungszweck': 'Benchmark', 'Betrag (€)': -12.5,
+                 'Kategorie': 'sonstiges'}
+
+        results = {
+            'ingest': measure(lambda: model._load_data(csv_file), repeat),
+            'classify': measure(lambda: model.classifier.classify_frame(raw_frame), repeat),
+            'startup': measure(lambda: Model(csv_dir), repeat),
+            'refresh_cold': measure(lambda: Model(csv_dir, rebuild_cache=True).load_all(), max(1, repeat // 2)),
+            'refresh_sidecar': measure(lambda: Model(csv_dir).load_all(), repeat),
+            'refresh_unchanged': measure(model.refresh_data, repeat),
+            'aggregate_file': measure(lambda: FileIndex(model.data[csv_file], model.dates[csv_file]), repeat),
+            'aggregate_ledger': measure(lambda: model.totals('MS'), repeat, setup=drop_ledger),
+            'render_tab': measure(lambda: view.tab(csv_file), repeat),
+            'render_tab_cached': measure(lambda: view.render(csv_file), repeat),
+            'render_all_time': measure(view.all_time_tab, repeat, setup=drop_ledger),
+            'details_page': measure(lambda: view.details_page({'csv': csv_file, 'kind': 'expenses'}, 3, 10), repeat),
+            'details_dataset': measure(lambda: json.dumps(model.details_dataset(csv_file)), repeat),
+            'upload': measure(
+                lambda: model.classify_and_save_upload(upload, os.path.basename(upload_path)),
+                repeat, setup=remove_upload),
+            'add_entry': measure(lambda: model.add_entry(csv_file, entry), repeat),
+            'save_dirty': measure(model.save, repeat, setup=lambda: model.update_index(csv_file)),
+        }
+        model.compact()
+        remove_upload()
+        seconds, problems = check_recovery(csv_dir)
+        results['recover_compaction'] = {'min': seconds, 'median': seconds, 'repeat': 1, 'problems': problems}
+        seconds, problems = check_saved_edit(csv_dir)
+        results['save_rebuilt'] = {'min': seconds, 'median': seconds, 'repeat': 1, 'problems': problems}
+        return results
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare(results, baseline, threshold, min_delta):
+    """Print current vs baseline medians, return the list of regressions
+
+    A benchmark regressed if its median got slower by more than threshold (relative) and
+    by more than min_delta seconds, so that timer noise on sub-millisecond runs is ignored.
+    """
+    regressions = []
+    print(f"\n{'Size':<8} {'Benchmark':<20} {'Baseline':>10} {'Current':>10} {'Change':>8}")
+    for size, benchmarks in results['results'].items():
+        for name, current in benchmarks.items():
+            previous = baseline.get('results', {}).get(size, {}).get(name)
+            if previous is None:
+                continue
+            change = current['median'] / previous['median'] - 1 if previous['median'] else 0.0
+            slower = current['median'] - previous['median']
+            flag = '  REGRESSION' if change > threshold and slower > min_delta else ''
+            print(f"{size:<8} {name:<20} {previous['median'] * 1000:>8.1f}ms {current['median'] * 1000:>8.1f}ms "
+                  f"{change:>+7.0%}{flag}")
+            if flag:
+                regressions.append((size, name, change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the expenses data paths on synthetic bank exports.")
+    parser.add_argument('--sizes', nargs='+', default=['small', 'medium'], choices=list(SIZES),
+                        help="Data sizes to run (default: small medium)")
+    parser.add_argument('--repeat', type=int, default=5, help="Runs per benchmark (default: 5)")
+    parser.add_argument('--output', default=os.path.join('benchmarks', 'results', 'latest.json'),
+                        help="Where to write the JSON results")
+    parser.add_argument('--baseline', help="JSON results to compare against")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="Relative slowdown of the median reported as regression (default: 0.2)")
+    parser.add_argument('--min-delta-ms', type=float, default=1.0,
+                        help="Ignore slowdowns smaller than this many milliseconds (default: 1.0)")
+    parser.add_argument('--save-baseline', help="Also write the results to this baseline file")
+    args = parser.parse_args()
+
+    results = {
+        'meta': {
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+        },
+        'results': {},
+    }
+    for size in args.sizes:
+        files, rows = SIZES[size]
+        print(f"Running {size}: {files} files x {rows} rows")
+        results['results'][size] = run_size(size, files, rows, args.repeat)
+        for name, timing in results['results'][size].items():
+            print(f"  {name:<20} {timing['median'] * 1000:>10.1f} ms")
+            for problem in timing.get('problems', []):
+                print(f"  {name}: {problem}")
+
+    for path in filter(None, [args.output, args.save_baseline]):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    failed = [size for size, benchmarks in results['results'].items()
+              if any(timing.get('problems') for timing in benchmarks.values())]
+    if failed:
+        print(f"\nCrash recovery failed for {', '.join(failed)}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, args.min_delta_ms / 1000)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) above {args.threshold:.0%}")
+            sys.exit(1)
+        print("\nNo regressions")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,10 +4,27 @@ Expenses package for managing and visualizing financial data.
 
 __version__ = "1.0.0"
 
-from .model.model import Model
-from .view.view import View
-from .controller.controller import Controller
-from .classifier import Classifier
-from .plot import Plot
+import importlib
+
+# Imported on first access, so that e.g. importing Model does not load matplotlib or Dash
+_LAZY = {
+    "Model": ".model.model",
+    "View": ".view.view",
+    "Controller": ".controller.controller",
+    "Classifier": ".classifier",
+    "Plot": ".plot",
+}
 
 __all__ = ["Model", "View", "Controller", "Classifier", "Plot"]
+
+
+def __getattr__(name):
+    if name in _LAZY:
+        value = getattr(importlib.import_module(_LAZY[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
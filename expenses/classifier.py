@@ -1,60 +1,229 @@
-from openai import OpenAI
-import os
 import yaml
 import csv
 import pandas as pd
 import argparse
 import glob
+import re
+import numpy as np
+
+from .model.reader import sniff
+from .metrics import REGISTRY
+from .classifier_cache import ClassificationCache, rules_hash
+
+
+RULES_PATH = 'config/categories.yaml'
+
+
+def load_categories(path=RULES_PATH):
+    """Read the category rules as {name: {'keywords': [...]}}, in the order of the file"""
+    with open(path, 'r', encoding='utf-8') as f:
+        categories_yaml = yaml.safe_load(f)
+    categories_list = categories_yaml.get("Categories", [])
+    # Convert list of dicts to dict with category name as key
+    return {cat["name"]: {"keywords": cat["keywords"]} for cat in categories_list}
+
+
+def transaction_texts(payee, purpose):
+    """The text of each row that keywords are matched against"""
+    return payee.astype(str) + " " + purpose.astype(str)
+
+
+class KeywordIndex:
+    """Inverted index from keywords to the positions of the texts containing them
+
+    Every keyword is searched once in all texts joined together and the hits mapped back
+    to their text, lookups are remembered so the same keyword is never searched twice.
+    """
+    def __init__(self, texts):
+        self.texts = [text.lower() for text in texts]
+        self._blob = "\0".join(self.texts)
+        self._starts = np.cumsum([0] + [len(text) + 1 for text in self.texts[:-1]])
+        self._matches = {}
+        self._positions = None
+
+    def positions(self, texts):
+        """Positions of indexed texts"""
+        if self._positions is None:
+            self._positions = {text: position for position, text in enumerate(self.texts)}
+        return np.array([self._positions[text.lower()] for text in texts], dtype=np.intp)
+
+    def matches(self, keyword):
+        """Sorted positions of the texts containing the keyword, case insensitive"""
+        keyword = keyword.lower()
+        if keyword not in self._matches:
+            if not keyword:
+                self._matches[keyword] = np.arange(len(self.texts))
+            else:
+                positions = [m.start() for m in re.finditer(re.escape(keyword), self._blob)]
+                self._matches[keyword] = np.unique(np.searchsorted(self._starts, positions, side='right') - 1)
+        return self._matches[keyword]
 
 
 class Classifier:
-    def __init__(self, categories):
+    def __init__(self, categories, cache_path=None, fallback=None):
+        """cache_path is an optional SQLite file remembering the category of every text seen before,
+        fallback an optional LLMClassifier asked about the texts no keyword matches"""
         self.categories = categories
-        self.client = OpenAI(
-            # This is the default and can be omitted
-            api_key=os.environ.get("OPENAI_API_KEY"),
-        )
+        self._compile()
+        self.cache = ClassificationCache(cache_path, rules_hash(categories)) if cache_path else None
+        self.fallback = fallback
 
-    def classify(self, text):
-        text_lower = text.lower()
-        max_overlap = 0
-        best_category = None
-
-        for category, info in self.categories.items():
-            keywords = info.get("keywords", [])
-            overlap = sum(1 for kw in keywords if kw.lower() in text_lower)
-            if overlap > max_overlap:
-                max_overlap = overlap
-                best_category = category
-
-        if best_category is not None and max_overlap > 0:
-            return best_category
+    def set_categories(self, categories):
+        """Switch to new category rules, returns the keywords whose effect changed
+
+        Returns None if every text has to be classified again, i.e. when the order of the
+        categories that stay changed, since the first category wins ties.
+        """
+        old = self._keyword_categories()
+        old_names = [name for name in self._names if name in categories]
+        self.categories = categories
+        self._compile()
+        if self.cache is not None:
+            self.cache.set_rules(rules_hash(categories))
+        if self.fallback is not None:
+            self.fallback.set_categories(categories)
+        new = self._keyword_categories()
+        if old_names != [name for name in self._names if name in old_names]:
+            return None
+        return {kw for kw in old.keys() | new.keys() if old.get(kw) != new.get(kw)}
+
+    def _keyword_categories(self):
+        """{keyword: [(category, count), ...]} of the compiled rules"""
+        return {
+            kw: [(self._names[column], int(count)) for column, count in enumerate(weights) if count]
+            for kw, weights in zip(self._keywords, self._weights)
+        }
+
+    def _compile(self):
+        """Compile the category configuration into a keyword list and a keyword x category count matrix"""
+        self._names = list(self.categories)
+        keyword_ids = {}
+        pairs = []
+        for column, info in enumerate(self.categories.values()):
+            for kw in info.get("keywords", []):
+                pairs.append((keyword_ids.setdefault(kw.lower(), len(keyword_ids)), column))
+        self._keywords = list(keyword_ids)
+        # A keyword listed twice in a category counts twice, just like in the substring loop
+        self._weights = np.zeros((len(self._keywords), len(self._names)), dtype=np.int64)
+        for row, column in pairs:
+            self._weights[row, column] += 1
+
+    def _classify_texts(self, texts, index=None):
+        """Classify a list of texts with the compiled keyword matrix, None where no keyword matches
+
+        index is an optional KeywordIndex containing the texts, whose keyword lookups are reused.
+        """
+        slots = None
+        if index is None:
+            index = KeywordIndex(texts)
         else:
-            print(f"No category found with keyword overlap for text: '{text}'")
-            return "sonstiges"
-    
-    def classify_file(self, input_file, output_file):
-        try:
-            df = pd.read_csv(input_file, delimiter=';', encoding='utf-8')
-        except Exception as e:
-            df = pd.read_csv(input_file, delimiter=';', encoding='utf-8', skiprows=4)
-        # Drop rows with any missing values in the selected columns
-        #df = df.dropna()
-        #df = df[~df['Zahlungsempfänger*in'].isin(['Julia Sperger', 'Philipp Dürnay'])]
-        categories = []
-        for _, row in df.iterrows():
-            if any(column not in row for column in ['Zahlungsempfänger*in', 'Verwendungszweck']):
-                categories.append(None)
-                continue
-            line_text = " ".join(str(item) for item in row[["Zahlungsempfänger*in", 'Verwendungszweck']])
-            try:
-                category = self.classify(line_text)
-                categories.append(category)
-            except ValueError as e:
-                print(e)
-                categories.append(None)
-        df['Kategorie'] = categories
-        df.to_csv(output_file, index=False, encoding='utf-8', sep=';')
+            # Row of each indexed text in the scores, -1 for texts not asked about
+            slots = np.full(len(index.texts), -1, dtype=np.intp)
+            slots[index.positions(texts)] = np.arange(len(texts))
+        scores = np.zeros((len(texts), len(self._names)), dtype=np.int64)
+        for kw, weights in zip(self._keywords, self._weights):
+            rows = index.matches(kw)
+            if slots is not None:
+                rows = slots[rows]
+                rows = rows[rows >= 0]
+            scores[rows] += weights
+        if not self._names:
+            return [None] * len(texts)
+        # argmax picks the first category with the highest overlap, like the strict '>' loop
+        best = scores.argmax(axis=1)
+        names = np.array(self._names + [None], dtype=object)
+        return names[np.where(scores[np.arange(len(texts)), best] > 0, best, len(self._names))].tolist()
+
+    def _classify_cached(self, texts, index=None):
+        """Classify distinct texts, only matching the keywords against texts never seen before
+
+        Texts are cached lowercased, exactly as the keywords are matched against them. Texts
+        without a keyword match are cached as None and handed to the fallback in one go,
+        whatever the fallback cannot classify ends up as 'sonstiges'. With a KeywordIndex the
+        texts are its texts and its keyword lookups are reused.
+        """
+        lowered = texts if index is not None else [text.lower() for text in texts]
+        known = {}
+        if self.cache is not None:
+            known = self.cache.get_many(list(set(lowered)))
+            REGISTRY.inc('expenses_classifier_cache_hits_total', len(known),
+                         help='Distinct texts whose category came from the cache')
+        missing = list(dict.fromkeys(text for text in lowered if text not in known))
+        if missing:
+            found = dict(zip(missing, self._classify_texts(missing, index)))
+            if self.cache is not None:
+                self.cache.put_many(found)
+            known.update(found)
+        unmatched = [text for text in dict.fromkeys(lowered) if known[text] is None]
+        if unmatched and self.fallback is not None:
+            answers = self.fallback.classify(unmatched)
+            REGISTRY.inc('expenses_classifier_fallback_texts_total', len(answers),
+                         help='Distinct texts classified by the fallback')
+            if self.cache is not None:
+                self.cache.put_many(answers)
+            known.update(answers)
+            unmatched = [text for text in unmatched if known[text] is None]
+        if unmatched:
+            print(f"No category found for {len(unmatched)} texts, classified as 'sonstiges'")
+        return [known[text] or "sonstiges" for text in lowered]
+
+    def classify_indexed(self, index, positions):
+        """Categories of the texts of a KeywordIndex at positions"""
+        return np.array(self._classify_cached([index.texts[position] for position in positions], index),
+                        dtype=object)
+
+    def classify(self, text):
+        return self._classify_cached([text])[0]
+
+    def classify_series(self, payee, purpose, progress=None, chunk_texts=5000):
+        """Classify whole payee and purpose columns at once, each distinct text is matched only once
+
+        With progress the distinct texts are classified chunk_texts at a time, and progress is
+        called with the number of rows classified so far after each chunk.
+        """
+        with REGISTRY.timer('expenses_classifier_batch_seconds', help='Time to classify a batch of rows'):
+            texts = transaction_texts(payee, purpose)
+            codes, uniques = pd.factorize(texts)
+            if progress is None:
+                categories = np.array(self._classify_cached(list(uniques)), dtype=object)
+            else:
+                categories = np.empty(len(uniques), dtype=object)
+                rows = np.cumsum(np.bincount(codes[codes >= 0], minlength=len(uniques)))
+                for start in range(0, len(uniques), chunk_texts):
+                    end = min(start + chunk_texts, len(uniques))
+                    categories[start:end] = self._classify_cached(list(uniques[start:end]))
+                    progress(int(rows[end - 1]))
+        REGISTRY.inc('expenses_classifier_rows_total', len(codes), help='Rows classified')
+        REGISTRY.inc('expenses_classifier_texts_total', len(uniques), help='Distinct texts in classified batches')
+        return pd.Series(categories[codes], index=payee.index, dtype=object)
+
+    def classify_frame(self, df, progress=None):
+        """Classify the rows of a bank export, None for all rows if the text columns are missing"""
+        if any(column not in df.columns for column in ['Zahlungsempfänger*in', 'Verwendungszweck']):
+            return pd.Series([None] * len(df), index=df.index, dtype=object)
+        return self.classify_series(df['Zahlungsempfänger*in'], df['Verwendungszweck'], progress)
+
+    def classify_file(self, input_file, output_file, chunksize=None):
+        """Classify a bank export and write it with a 'Kategorie' column, returns the number of rows
+
+        With a chunksize the file is streamed: each chunk is classified and appended to the
+        output before the next one is read, so memory stays bounded for large exports.
+        """
+        fmt = sniff(input_file)
+        chunks = pd.read_csv(input_file, delimiter=fmt.delimiter, encoding=fmt.encoding,
+                             skiprows=fmt.skiprows, dtype=str, chunksize=chunksize)
+        if chunksize is None:
+            chunks = [chunks]
+        rows = 0
+        for df in chunks:
+            # Drop rows with any missing values in the selected columns
+            #df = df.dropna()
+            #df = df[~df['Zahlungsempfänger*in'].isin(['Julia Sperger', 'Philipp Dürnay'])]
+            df['Kategorie'] = self.classify_frame(df)
+            df.to_csv(output_file, index=False, encoding='utf-8', sep=';',
+                      mode='w' if rows == 0 else 'a', header=rows == 0)
+            rows += len(df)
+        return rows
         
     def convert_betrag_column(self, df):
         """Convert 'Betrag (€)' column from German to standard decimal notation."""
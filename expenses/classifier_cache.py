@@ -0,0 +1,87 @@
+"""Persistent cache of classified transaction texts.
+
+Bank exports repeat the same payee and purpose texts month after month, so the
+category of each lowercased text is kept in a SQLite file. The file is stamped
+with a hash of the category rules and emptied whenever they change.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+
+# SQLite limits the number of parameters of one statement
+BATCH_SIZE = 500
+# Bumped when the meaning of stored categories changes, 2 stores None for texts no keyword matches,
+# 3 keys the texts as the keywords are matched against them, only lowercased
+CACHE_VERSION = 3
+
+
+def rules_hash(categories):
+    """Hash of the category configuration, any change to names or keywords changes it"""
+    rules = {'version': CACHE_VERSION, 'categories': categories}
+    return hashlib.sha1(json.dumps(rules, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def normalize(text):
+    """Lowercase and collapse whitespace, for comparing texts of the same booking, see fingerprints.py"""
+    return " ".join(text.lower().split())
+
+
+class ClassificationCache:
+    def __init__(self, path, rules):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Shared by the Dash worker threads, the lock serializes access
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._db:
+            # Import workers write to the same file from several processes
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS classifications (text TEXT PRIMARY KEY, category TEXT)")
+        self.set_rules(rules)
+
+    def set_rules(self, rules):
+        """Stamp the cache with the hash of the category rules, dropping results of other rules"""
+        with self._lock, self._db:
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'rules'").fetchone()
+            if row is None or row[0] != rules:
+                self._db.execute("DELETE FROM classifications")
+                self._db.execute("INSERT OR REPLACE INTO meta VALUES ('rules', ?)", (rules,))
+        self.rules = rules
+
+    def get_many(self, texts):
+        """Return {text: category} for the lowercased texts that are cached"""
+        found = {}
+        with self._lock:
+            for start in range(0, len(texts), BATCH_SIZE):
+                batch = texts[start:start + BATCH_SIZE]
+                found.update(self._db.execute(
+                    f"SELECT text, category FROM classifications WHERE text IN ({','.join('?' * len(batch))})",
+                    batch,
+                ).fetchall())
+        self.hits += len(found)
+        self.misses += len(texts) - len(found)
+        return found
+
+    def put_many(self, results):
+        """Store {text: category} for lowercased texts"""
+        if not results:
+            return
+        with self._lock, self._db:
+            self._db.executemany("INSERT OR REPLACE INTO classifications VALUES (?, ?)", results.items())
+
+    def clear(self):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM classifications")
+
+    def close(self):
+        self._db.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM classifications").fetchone()[0]
@@ -1,90 +1,272 @@
 import dash
-from dash import dcc, html, Input, Output, dash_table, State
+from dash import html, Input, Output, State, ALL
 from dash import callback_context
+from dash.exceptions import PreventUpdate
 import base64
-import io
-import pandas as pd
 import os
 
+from ..metrics import instrument
+from ..model.uploads import UploadQueue
+from ..view.view import ALL_TIME
+
+
+FILTER_OPERATORS = [['ge ', '>='], ['le ', '<='], ['lt ', '<'], ['gt ', '>'], ['ne ', '!='], ['eq ', '='],
+                    ['contains '], ['datestartswith ']]
+
+
+def split_filter_query(filter_query):
+    """Split a DataTable filter query into (column, operator, value) tuples
+
+    Each part is {column} operator value, the operator is looked for right after the
+    column, so operators in column names or values do not count. Operators may have
+    the i or s prefix of case insensitive or sensitive matching.
+    """
+    filters = []
+    for filter_part in (filter_query or '').split(' && '):
+        filter_part = filter_part.strip()
+        end = filter_part.find('}')
+        if not filter_part.startswith('{') or end < 0:
+            continue
+        name = filter_part[1:end]
+        rest = filter_part[end + 1:].lstrip()
+        for operator_type in FILTER_OPERATORS:
+            operator = next((op for op in operator_type
+                             if rest.startswith(op) or (rest[:1] in ('i', 's') and rest[1:].startswith(op))), None)
+            if operator is None:
+                continue
+            value_part = rest[rest.index(operator) + len(operator):].strip()
+            quote = value_part[:1]
+            if len(value_part) > 1 and quote == value_part[-1] and quote in ("'", '"', '`'):
+                value = value_part[1:-1].replace('\\' + quote, quote)
+            elif operator_type[0] in ('contains ', 'datestartswith '):
+                # Text matches, 01. is the start of a date and not a number
+                value = value_part
+            else:
+                try:
+                    value = float(value_part)
+                except ValueError:
+                    value = value_part
+            filters.append((name, operator_type[0].strip(), value))
+            break
+    return filters
+
+
+# Picks the drill-down of a click on the pie or bar chart, for the selection store of either mode
+SHOW_DETAILS_JS = """
+function(pieClick, barClick, selectedCsv, selections) {
+    const triggered = dash_clientside.callback_context.triggered.map(t => t.prop_id.split('.')[0]);
+    let title = 'Click a category to see details';
+    let selection = {csv: selectedCsv, kind: 'all'};
+    if (triggered.includes('category-pie-2') && pieClick && 'label' in pieClick.points[0]) {
+        const category = pieClick.points[0].label;
+        title = 'Details for category: ' + category;
+        selection = {csv: selectedCsv, kind: 'category', category: category};
+    } else if (triggered.includes('bar-fig') && barClick && 'label' in barClick.points[0]) {
+        const expenses = barClick.points[0].label === 'Expense';
+        title = expenses ? 'Expenses' : 'Income';
+        selection = {csv: selectedCsv, kind: expenses ? 'expenses' : 'income'};
+    }
+    return [title, selections.map(() => selection), selections.map(() => 0)];
+}
+"""
+
+# Rows of a drill-down from the dataset of Model.details_dataset, sorted like Model.details_page does
+LOCAL_DETAILS_JS = """
+function(selection, sortBy, dataset) {
+    if (!selection || !dataset || selection.csv !== dataset.csv) {
+        return [[], dash_clientside.no_update];
+    }
+    const kind = selection.kind;
+    let rows;
+    if (kind === 'expenses') {
+        rows = dataset.expenses;
+    } else if (kind === 'income') {
+        rows = dataset.income;
+    } else if (kind === 'category') {
+        rows = dataset.categories[selection.category] || [];
+    } else {
+        rows = dataset.amounts.map((amount, i) => i);
+    }
+    const columns = kind === 'income' ? dataset.income_columns : dataset.detail_columns;
+    const value = (column, i) => {
+        if (column === 'Betrag (€)') {
+            // The overview table lists all amounts as absolute values
+            const cents = dataset.amounts[i];
+            return (kind === 'all' ? Math.abs(cents) : cents) / 100;
+        }
+        const values = dataset.columns[column];
+        return values && values.codes[i] >= 0 ? values.values[values.codes[i]] : null;
+    };
+    // Drill-downs are sorted by amount unless the user sorts by another column
+    let sort = sortBy && sortBy.length ? sortBy[0] : null;
+    if (!sort && kind !== 'all') {
+        sort = {column_id: 'Betrag (€)', direction: 'asc'};
+    }
+    if (sort && columns.includes(sort.column_id)) {
+        const key = sort.column_id === 'Buchungsdatum' ? (i => dataset.days[i]) : (i => value(sort.column_id, i));
+        const sign = sort.direction === 'asc' ? 1 : -1;
+        // Stable, with missing values last in both directions
+        rows = rows.slice().sort((a, b) => {
+            const x = key(a), y = key(b);
+            if (x === null || y === null) {
+                return (x === null) - (y === null);
+            }
+            return x < y ? -sign : x > y ? sign : 0;
+        });
+    }
+    const records = rows.map(i => Object.fromEntries(columns.map(column => [column, value(column, i)])));
+    return [records, columns.map(column => ({name: column, id: column}))];
+}
+"""
+
 
 class Controller:
     def __init__(self, app, model, view):
         self.app = app
         self.model = model
         self.view = view
+        # Uploads are classified and saved off the request thread
+        self.uploads = UploadQueue(model)
         self.register_callbacks()
 
     def register_callbacks(self):
         @self.app.callback(
         Output('tab-content', 'children'),
         Input('csv-tabs', 'value'))
+        @instrument('render_tab')
         def render_tab(selected_csv):
-            return self.view.tab(selected_csv=selected_csv)
+            return self.view.render(selected_csv)
         
         @self.app.callback(
+            Output('files-generation', 'data'),
+            Output('csv-tabs', 'children', allow_duplicate=True),
+            Output('csv-tabs', 'value', allow_duplicate=True),
+            Output('tab-content', 'children', allow_duplicate=True),
+            Input('refresh-interval', 'n_intervals'),
+            State('files-generation', 'data'),
+            State('csv-tabs', 'value'),
+            prevent_initial_call=True)
+        @instrument('refresh_files')
+        def refresh_files(n_intervals, generation, selected_csv):
+            # Files picked up in the background since the page was built, nothing to send if there are none
+            current = self.model.generation
+            if generation == current:
+                raise PreventUpdate
+            if selected_csv != ALL_TIME and selected_csv not in self.model.data:
+                # The open file was removed, render_tab follows the new value
+                value = self.model.csv_files[-1] if self.model.csv_files else ALL_TIME
+                return current, self.view.tabs(), value, dash.no_update
+            return current, self.view.tabs(), dash.no_update, self.view.render(selected_csv)
+
+        # Clicks on the charts only pick a drill-down, no server round trip needed
+        self.app.clientside_callback(
+            SHOW_DETAILS_JS,
             Output('details-title', 'children'),
-            Output('details-table', 'data'),
+            Output({'type': 'details-selection', 'mode': ALL}, 'data'),
+            Output({'type': 'details-table', 'mode': ALL}, 'page_current'),
             Input('category-pie-2', 'clickData'),
             Input('bar-fig', 'clickData'),
-            Input('csv-tabs', 'value'))
-        def show_details(pie_click,bar_click, selected_csv):
-            ctx = callback_context
-            triggered = ctx.triggered[0]['prop_id'].split('.')[0] if ctx.triggered else None
-
-            if triggered == 'category-pie-2' and pie_click and 'label' in pie_click['points'][0]:
-                return self.view.detailed_expenses_in_category(selected_csv, category=pie_click['points'][0]['label'])
-                
-            if triggered == 'bar-fig' and bar_click and 'label' in bar_click['points'][0]:
-                group = bar_click['points'][0]['label']
-                if group == 'Expense':
-                    return self.view.detailed_expenses(selected_csv)
-                else:
-                    return self.view.detailed_income(selected_csv)
-
-            return "Click a category to see details", []
+            Input('csv-tabs', 'value'),
+            State({'type': 'details-selection', 'mode': ALL}, 'data'))
+
+        # Drill-downs of small files are filtered and sorted in the browser, see View.details
+        self.app.clientside_callback(
+            LOCAL_DETAILS_JS,
+            Output({'type': 'details-table', 'mode': 'client'}, 'data'),
+            Output({'type': 'details-table', 'mode': 'client'}, 'columns'),
+            Input({'type': 'details-selection', 'mode': 'client'}, 'data'),
+            Input({'type': 'details-table', 'mode': 'client'}, 'sort_by'),
+            State('details-data', 'data'))
+
+        @self.app.callback(
+            Output({'type': 'details-table', 'mode': 'server'}, 'data'),
+            Output({'type': 'details-table', 'mode': 'server'}, 'page_count'),
+            Output({'type': 'details-table', 'mode': 'server'}, 'columns'),
+            Input({'type': 'details-selection', 'mode': 'server'}, 'data'),
+            Input({'type': 'details-table', 'mode': 'server'}, 'page_current'),
+            Input({'type': 'details-table', 'mode': 'server'}, 'page_size'),
+            Input({'type': 'details-table', 'mode': 'server'}, 'sort_by'),
+            Input({'type': 'details-table', 'mode': 'server'}, 'filter_query'))
+        @instrument('update_details_table')
+        def update_details_table(selection, page_current, page_size, sort_by, filter_query):
+            if not selection or selection.get('csv') not in self.model.data:
+                return [], 1, dash.no_update
+            sort_by = [(column['column_id'], column['direction'] == 'asc') for column in sort_by or []]
+            return self.view.details_page(selection, page_current or 0, page_size, sort_by,
+                                          split_filter_query(filter_query))
+
+        @self.app.callback(
+            Output('add-entry-output', 'children'),
+            Output('tab-content', 'children', allow_duplicate=True),
+            Input('add-entry-button', 'n_clicks'),
+            State({'type': 'entry-field', 'column': ALL}, 'value'),
+            State({'type': 'entry-field', 'column': ALL}, 'id'),
+            State('csv-tabs', 'value'),
+            prevent_initial_call=True)
+        @instrument('add_entry')
+        def add_entry(n_clicks, values, ids, selected_csv):
+            if selected_csv not in self.model.data:
+                return html.P('Select the tab of a file to add the entry to', style={'color': 'red'}), dash.no_update
+            entry = {field['column']: value for field, value in zip(ids, values)}
+            try:
+                # Journaled right away, the CSV is rewritten in the background
+                self.model.add_entry(selected_csv, entry)
+            except (KeyError, ValueError) as e:
+                return html.P(f'Error adding entry: {str(e)}', style={'color': 'red'}), dash.no_update
+            return html.P(f"Added entry to {os.path.basename(selected_csv)}", style={'color': 'green'}), \
+                self.view.render(selected_csv)
 
         @self.app.callback(
             Output('upload-output', 'children'),
-            Output('csv-tabs', 'children'),
-            Output('csv-tabs', 'value'),
+            Output('upload-interval', 'disabled'),
+            Output('upload-seen', 'data'),
             Input('upload-csv', 'contents'),
             State('upload-csv', 'filename'),
-            State('csv-tabs', 'children'))
-        def handle_upload(contents, filename, existing_tabs):
-            if contents is None:
-                return None, existing_tabs, existing_tabs[-1]['props']['value'] if existing_tabs else None
-
-            try:
-                # Decode the uploaded file
-                content_type, content_string = contents.split(',')
-                decoded = base64.b64decode(content_string)
-                
-                # Read the CSV file using the same simple logic as classifier.py
-                csv_content = decoded.decode('utf-8')
+            prevent_initial_call=True)
+        @instrument('handle_upload')
+        def handle_upload(contents, filenames):
+            # Earlier uploads are not opened when they are seen finished
+            seen = [job.id for job in self.uploads.jobs() if job.finished]
+            errors = []
+            for content, filename in zip(contents or [], filenames or []):
                 try:
-                    df = pd.read_csv(io.StringIO(csv_content), delimiter=';', encoding='utf-8')
-                except Exception:
-                    df = pd.read_csv(io.StringIO(csv_content), delimiter=';', encoding='utf-8', skiprows=4)
-                
-                # Use the model to classify and save the file
-                new_file_path = self.model.classify_and_save_file(df)
-                output_filename = os.path.basename(new_file_path)
-                
-                # Update tabs
-                new_tabs = [
-                    dcc.Tab(
-                        label=" ".join(os.path.basename(csv_file).split("_")[:2]),
-                        value=csv_file
-                    ) for csv_file in self.model.csv_files
-                ]
-                
-                return html.Div([
-                    html.P(f'Successfully processed and saved as {output_filename}', 
-                           style={'color': 'green'})
-                ]), new_tabs, new_file_path
-                
-            except Exception as e:
-                return html.Div([
-                    html.P(f'Error processing file: {str(e)}',
-                           style={'color': 'red'})
-                ]), existing_tabs, existing_tabs[-1]['props']['value'] if existing_tabs else None
+                    content_type, content_string = content.split(',')
+                    decoded = base64.b64decode(content_string)
+                except ValueError as e:
+                    errors.append(html.P(f'Error processing {filename}: {str(e)}', style={'color': 'red'}))
+                    continue
+                # Parsed, classified and saved by the upload queue, upload_progress reports on it
+                self.uploads.submit(decoded, filename)
+            return html.Div(errors + [self.view.upload_jobs(self.uploads.jobs())]), False, seen
+
+        @self.app.callback(
+            Output('upload-output', 'children', allow_duplicate=True),
+            Output('upload-interval', 'disabled', allow_duplicate=True),
+            Output('csv-tabs', 'children', allow_duplicate=True),
+            Output('csv-tabs', 'value', allow_duplicate=True),
+            Output('upload-seen', 'data', allow_duplicate=True),
+            Input('upload-interval', 'n_intervals'),
+            State('upload-seen', 'data'),
+            prevent_initial_call=True)
+        @instrument('upload_progress')
+        def upload_progress(n_intervals, seen):
+            jobs = self.uploads.jobs()
+            saved = [job for job in jobs if job.state == 'done' and job.id not in seen]
+            if not saved:
+                return self.view.upload_jobs(jobs), not self.uploads.active, dash.no_update, dash.no_update, \
+                    dash.no_update
+            # Open the file saved last, like a single upload always did
+            return self.view.upload_jobs(jobs), not self.uploads.active, self.view.tabs(), saved[-1].output, \
+                seen + [job.id for job in saved]
+
+        @self.app.callback(
+            Output('upload-output', 'children', allow_duplicate=True),
+            Input({'type': 'cancel-upload', 'job': ALL}, 'n_clicks'),
+            prevent_initial_call=True)
+        @instrument('cancel_upload')
+        def cancel_upload(n_clicks):
+            # Buttons are rendered again on every poll, only a click counts
+            if not callback_context.triggered or not callback_context.triggered[0]['value']:
+                raise PreventUpdate
+            self.uploads.cancel(callback_context.triggered_id['job'])
+            return self.view.upload_jobs(self.uploads.jobs())
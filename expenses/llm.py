@@ -0,0 +1,107 @@
+"""Second classification stage for texts no keyword matches.
+
+Unmatched texts are sent to a chat-completions compatible endpoint, many texts
+per prompt and several prompts at a time. The endpoint is configurable, so it
+can be OpenAI, a local model server or the stub in benchmarks/llm_stub.py.
+"""
+import asyncio
+import importlib.util
+import json
+import os
+import random
+
+from .metrics import REGISTRY
+
+
+DEFAULT_MODEL = 'gpt-4o-mini'
+
+SYSTEM_PROMPT = (
+    "You classify bank transactions into exactly one of these categories: {categories}. "
+    "The user sends a JSON object mapping ids to transaction texts (payee and purpose). "
+    "Answer with a JSON object mapping every id to one category name from the list."
+)
+
+
+class LLMClassifier:
+    def __init__(self, categories, base_url=None, model=DEFAULT_MODEL, api_key=None, batch_size=100,
+                 concurrency=8, retries=3, backoff=0.5, timeout=30.0):
+        """categories are the names to choose from, base_url None uses the OpenAI API"""
+        # Checked here, but only imported when texts are sent, openai takes long to import
+        if importlib.util.find_spec('openai') is None:
+            raise ImportError("The LLM fallback needs the openai package")
+        self.categories = list(categories)
+        self.base_url = base_url
+        self.model = model
+        self.api_key = api_key or os.environ.get('OPENAI_API_KEY') or 'not-needed'
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        # Answers of earlier batches, so a text is only ever sent once per process
+        self._answers = {}
+
+    def set_categories(self, categories):
+        """Offer other categories from now on, earlier answers may pick categories that are gone"""
+        self.categories = list(categories)
+        self._answers = {}
+
+    def classify(self, texts):
+        """Return {text: category} for the texts the endpoint classified, failed texts are left out"""
+        pending = [text for text in dict.fromkeys(texts) if text not in self._answers]
+        if pending:
+            self._answers.update(asyncio.run(self._classify_all(pending)))
+        return {text: self._answers[text] for text in texts if self._answers.get(text) is not None}
+
+    async def _classify_all(self, texts):
+        from openai import AsyncOpenAI
+
+        # Retries are done here, with backoff across the whole batch
+        client = AsyncOpenAI(base_url=self.base_url, api_key=self.api_key, timeout=self.timeout, max_retries=0)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        batches = [texts[start:start + self.batch_size] for start in range(0, len(texts), self.batch_size)]
+        try:
+            results = await asyncio.gather(*(self._classify_batch(client, semaphore, batch) for batch in batches))
+        finally:
+            await client.close()
+        answers = {}
+        for result in results:
+            answers.update(result)
+        return answers
+
+    async def _classify_batch(self, client, semaphore, texts):
+        """Classify one prompt worth of texts, returns {} if every attempt failed"""
+        messages = [
+            {'role': 'system', 'content': SYSTEM_PROMPT.format(categories=", ".join(self.categories))},
+            {'role': 'user', 'content': json.dumps({str(i): text for i, text in enumerate(texts)}, ensure_ascii=False)},
+        ]
+        for attempt in range(self.retries + 1):
+            async with semaphore:
+                try:
+                    with REGISTRY.timer('expenses_llm_request_seconds', help='Latency of LLM classification requests'):
+                        response = await client.chat.completions.create(
+                            model=self.model, messages=messages, temperature=0,
+                            response_format={'type': 'json_object'},
+                        )
+                    answers = self._parse(response.choices[0].message.content, texts)
+                    REGISTRY.inc('expenses_llm_texts_total', len(texts), help='Texts sent to the LLM')
+                    return answers
+                except Exception as e:
+                    REGISTRY.inc('expenses_llm_errors_total', help='Failed LLM classification requests')
+                    error = e
+            if attempt < self.retries:
+                # Exponential backoff with jitter, outside the semaphore so other batches can go
+                await asyncio.sleep(self.backoff * 2 ** attempt * (1 + random.random()))
+        print(f"LLM classification of {len(texts)} texts failed: {type(error).__name__}")
+        return {}
+
+    def _parse(self, content, texts):
+        """Map the ids of an answer back to texts, categories outside the list are dropped"""
+        answer = json.loads(content)
+        if not isinstance(answer, dict):
+            raise ValueError(f"expected a JSON object, got {type(answer).__name__}")
+        answers = {}
+        for key, category in answer.items():
+            if key.isdigit() and int(key) < len(texts) and category in self.categories:
+                answers[texts[int(key)]] = category
+        return answers
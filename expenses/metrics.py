@@ -0,0 +1,189 @@
+"""Lightweight in-process metrics, exposed in Prometheus text format on /metrics."""
+import cProfile
+import functools
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._help = {}
+
+    def inc(self, name, value=1, help=None, **labels):
+        """Add value to the counter name{labels}"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+            if help:
+                self._help.setdefault(name, help)
+
+    def set(self, name, value, help=None, **labels):
+        """Set the gauge name{labels} to value"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+            if help:
+                self._help.setdefault(name, help)
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, help=None, **labels):
+        """Record value in the histogram name{labels}"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram(buckets)
+            self._histograms[key].observe(value)
+            if help:
+                self._help.setdefault(name, help)
+
+    @contextmanager
+    def timer(self, name, help=None, **labels):
+        """Time the block into the histogram name{labels}, in seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, help=help, **labels)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+            histograms = sorted(self._histograms.items())
+            for kind, values in (('counter', counters), ('gauge', gauges)):
+                for name in sorted({key[0] for key, _ in values}):
+                    lines += self._header(name, kind)
+                    for (metric, labels), value in values:
+                        if metric == name:
+                            lines.append(f"{name}{_labels(labels)} {value}")
+            for name in sorted({key[0] for key, _ in histograms}):
+                lines += self._header(name, 'histogram')
+                for (histogram, labels), h in histograms:
+                    if histogram != name:
+                        continue
+                    for bound, count in zip(h.buckets, h.counts):
+                        lines.append(f"{name}_bucket{_labels(labels + (('le', repr(float(bound))),))} {count}")
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {h.count}")
+                    lines.append(f"{name}_sum{_labels(labels)} {h.sum}")
+                    lines.append(f"{name}_count{_labels(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def _header(self, name, kind):
+        header = [f"# HELP {name} {self._help[name]}"] if name in self._help else []
+        return header + [f"# TYPE {name} {kind}"]
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+
+REGISTRY = Registry()
+
+# Set by configure_profiling, profiles of callbacks slower than the threshold are dumped here
+_profile_dir = None
+_profile_threshold = None
+# Held while a callback is profiled
+_profile_lock = threading.Lock()
+
+
+def configure_profiling(profile_dir, threshold_ms=500):
+    """Profile every callback and dump the cProfile stats of those slower than threshold_ms"""
+    global _profile_dir, _profile_threshold
+    os.makedirs(profile_dir, exist_ok=True)
+    _profile_dir = profile_dir
+    _profile_threshold = threshold_ms / 1000
+
+
+def instrument(callback):
+    """Decorator counting calls, errors and latency of a Dash callback"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            REGISTRY.inc('expenses_callback_calls_total', help='Dash callback invocations', callback=callback)
+            profiler = _start_profiler(callback) if _profile_dir else None
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                REGISTRY.inc('expenses_callback_errors_total', help='Dash callbacks that raised', callback=callback)
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                REGISTRY.observe('expenses_callback_seconds', elapsed, help='Dash callback latency',
+                                 callback=callback)
+                if profiler is not None:
+                    profiler.disable()
+                    _profile_lock.release()
+                    if elapsed >= _profile_threshold:
+                        stamp = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+                        profiler.dump_stats(os.path.join(_profile_dir, f"{callback}-{stamp}-{elapsed * 1000:.0f}ms.prof"))
+        return wrapper
+    return decorator
+
+
+def _start_profiler(callback):
+    """A running profiler for one callback, None while another callback is profiled
+
+    Only one profiler can be active in a process at a time (Python 3.12 raises otherwise),
+    callbacks running concurrently with a profiled one are only timed.
+    """
+    if not _profile_lock.acquire(blocking=False):
+        REGISTRY.inc('expenses_callback_unprofiled_total', help='Callbacks not profiled, another one was',
+                     callback=callback)
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another profiling tool, e.g. a profiler around the whole server
+        _profile_lock.release()
+        return None
+    return profiler
+
+
+def register_metrics(server):
+    """Add the /metrics route and response size tracking of Dash callbacks to a Flask server"""
+    from flask import Response, request
+
+    @server.route('/metrics')
+    def metrics():
+        return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+    @server.after_request
+    def record_payload_size(response):
+        if request.path.endswith('/_dash-update-component'):
+            body = request.get_json(silent=True) or {}
+            REGISTRY.observe('expenses_callback_response_bytes', response.calculate_content_length() or 0,
+                             buckets=SIZE_BUCKETS, help='Serialized size of Dash callback responses',
+                             output=body.get('output', ''))
+        return response
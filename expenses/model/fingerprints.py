@@ -0,0 +1,207 @@
+"""Persistent index of transaction fingerprints, finding bookings that are in several files.
+
+Bank exports overlap: a date range downloaded again, or an upload saved under a fallback
+name, leaves the same bookings in several CSVs. Every row is hashed from its booking date,
+amount, IBAN and purpose, and each fingerprint belongs to the first file it was seen in.
+Rows of other files with that fingerprint are duplicates, which the aggregates over all
+files leave out. Lookups go to a dict in memory, one per row; a SQLite file next to the
+sidecars keeps the fingerprints each file owns across restarts, so a file parsed early in
+a run does not take the bookings of files that were not parsed yet.
+"""
+import json
+import os
+import sqlite3
+import threading
+
+import numpy as np
+import pandas as pd
+
+from ..classifier_cache import normalize
+
+
+def _compact_iban(text):
+    return text.replace(" ", "").upper()
+
+
+def _text_hashes(values, normalizer):
+    """Hash of the normalized text of each row, 0 where missing, each distinct text is normalized once"""
+    codes, uniques = pd.factorize(values)
+    normalized = np.asarray([normalizer(str(text)) for text in uniques], dtype=object)
+    return np.append(pd.util.hash_array(normalized), np.uint64(0))[codes]
+
+
+def _combine(*columns):
+    """One hash per row of several uint64 hash columns, depending on their order"""
+    combined = np.zeros(len(columns[0]), dtype=np.uint64)
+    for column in columns:
+        # Wraps around, the final hash mixes the bits again
+        combined = combined * np.uint64(1000003) + column
+    return pd.util.hash_array(combined)
+
+
+def _occurrence(keys):
+    """How many rows before each row have the same key, with a sort instead of a groupby"""
+    order = np.argsort(keys, kind='stable')
+    ordered = keys[order]
+    positions = np.arange(len(keys))
+    starts = np.maximum.accumulate(np.where(np.r_[True, ordered[1:] != ordered[:-1]], positions, 0))
+    occurrence = np.empty(len(keys), dtype=np.uint64)
+    occurrence[order] = positions - starts
+    return occurrence
+
+
+def row_keys(df, dates, start=0):
+    """Hash of the normalized booking date, amount, IBAN and purpose of the rows from start on
+
+    dates are the parsed booking dates of all rows.
+    """
+    count = len(df) - start
+    missing = np.zeros(count, dtype=np.uint64)
+    return _combine(
+        dates[start:].as_unit('ns').asi8.view(np.uint64),
+        np.asarray(df['Betrag (€)'].iloc[start:], dtype=np.int64).view(np.uint64),
+        _text_hashes(df['IBAN'].iloc[start:], _compact_iban) if 'IBAN' in df.columns else missing,
+        _text_hashes(df['Verwendungszweck'].iloc[start:], normalize) if 'Verwendungszweck' in df.columns else missing,
+    )
+
+
+def fingerprints(keys, previous=None):
+    """The fingerprint of every row as int64, from the row_keys of a file or of rows appended to it
+
+    Bookings that are equal in all fields are told apart by their occurrence in the file,
+    so a booking a file has twice only counts as a duplicate if another file has it twice.
+    previous are the keys of the rows before appended ones.
+    """
+    occurrence = _occurrence(keys)
+    if previous is not None:
+        occurrence += np.array([np.count_nonzero(previous == key) for key in keys.tolist()], dtype=np.uint64)
+    # SQLite integers are signed
+    return _combine(keys, occurrence).view(np.int64)
+
+
+class FingerprintIndex:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = None
+        # {file name: (stamp of the content it was indexed with, its number of duplicates)}
+        self._files = None
+        # {fingerprint: file name} and {file name: fingerprints it owns}, read when a file is first added
+        self._owners = None
+        self._claims = {}
+        # Files listed at startup, files missing or changed since are dropped on first use
+        self._retain = None
+
+    def _open(self):
+        if self._files is not None:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        # Shared by the Dash worker threads, the lock serializes access
+        self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        with self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            # Rebuilt from the CSVs if lost, no need to wait for the disk on every file
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            # The fingerprints a file owns as one int64 array, written and read per file
+            self._db.execute("CREATE TABLE IF NOT EXISTS files "
+                             "(file TEXT PRIMARY KEY, stamp TEXT, duplicates INTEGER, claims BLOB)")
+        self._files = {name: (tuple(json.loads(stamp)), duplicates) for name, stamp, duplicates
+                       in self._db.execute("SELECT file, stamp, duplicates FROM files").fetchall()}
+        if self._retain is not None:
+            for name in list(self._files):
+                if self._retain.get(name) != self._files[name][0]:
+                    self._release(name)
+            self._retain = None
+
+    def _load(self):
+        self._open()
+        if self._owners is not None:
+            return
+        self._claims = {name: np.frombuffer(claims, dtype=np.int64)
+                        for name, claims in self._db.execute("SELECT file, claims FROM files").fetchall()}
+        self._owners = {}
+        for name, claims in self._claims.items():
+            self._owners.update(dict.fromkeys(claims.tolist(), name))
+
+    def retain(self, stamps):
+        """Drop the files that are not in {file name: stamp} or changed since they were indexed
+
+        For the files listed when a model starts, applied when the index is first used.
+        """
+        with self._lock:
+            if self._files is None:
+                self._retain = {name: tuple(stamp) for name, stamp in stamps.items()}
+
+    def unique(self, name, stamp):
+        """Whether the file was indexed with this content and none of its rows were in other files
+
+        Its rows need no lookups then, whatever files were added since, it owns all of them.
+        """
+        with self._lock:
+            self._open()
+            return self._files.get(name) == (tuple(stamp), 0)
+
+    def add(self, name, stamp, hashes):
+        """Index the rows of a new or changed file, returns (positions of duplicates, whether any were released)
+
+        A row is a duplicate if its fingerprint belongs to another file. Fingerprints the
+        file had before but not any more are released; rows of other files that were
+        duplicates of them are not until those files are added again.
+        """
+        with self._lock:
+            self._load()
+            previous = self._claims.get(name, np.array([], dtype=np.int64))
+            released = np.setdiff1d(previous, hashes)
+            for fingerprint in released.tolist():
+                if self._owners.get(fingerprint) == name:
+                    del self._owners[fingerprint]
+            # One dict lookup per row, claiming the fingerprints nobody owns yet
+            setdefault = self._owners.setdefault
+            duplicate = np.fromiter((setdefault(fingerprint, name) != name for fingerprint in hashes.tolist()),
+                                    dtype=bool, count=len(hashes))
+            claimed = hashes[~duplicate]
+            indexed = (tuple(stamp), int(duplicate.sum()))
+            if self._files.get(name) != indexed or not np.array_equal(claimed, previous):
+                self._files[name] = indexed
+                with self._db:
+                    self._db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                                     (name, json.dumps(list(stamp)), indexed[1], claimed.tobytes()))
+            self._claims[name] = claimed
+            return np.flatnonzero(duplicate), len(released) > 0
+
+    def extend(self, name, hashes):
+        """Look up rows appended to an added file, returns the positions of duplicates among them
+
+        Only kept in memory, the file is indexed again once it is written and its stamp changed.
+        """
+        with self._lock:
+            self._load()
+            setdefault = self._owners.setdefault
+            duplicate = np.fromiter((setdefault(fingerprint, name) != name for fingerprint in hashes.tolist()),
+                                    dtype=bool, count=len(hashes))
+            self._claims[name] = np.concatenate([self._claims.get(name, np.array([], dtype=np.int64)),
+                                                 hashes[~duplicate]])
+            return np.flatnonzero(duplicate)
+
+    def remove(self, name):
+        """Release the fingerprints of a removed file, returns whether it had any"""
+        with self._lock:
+            self._load()
+            return self._release(name)
+
+    def _release(self, name):
+        claimed = self._claims.pop(name, np.array([], dtype=np.int64))
+        self._files.pop(name, None)
+        if self._owners is not None:
+            for fingerprint in claimed.tolist():
+                if self._owners.get(fingerprint) == name:
+                    del self._owners[fingerprint]
+        row = self._db.execute("SELECT length(claims) FROM files WHERE file = ?", (name,)).fetchone()
+        with self._db:
+            self._db.execute("DELETE FROM files WHERE file = ?", (name,))
+        return bool(row and row[0])
+
+    def __len__(self):
+        with self._lock:
+            self._load()
+            return len(self._owners)
@@ -0,0 +1,62 @@
+"""Per-file aggregate index, so tabs and drill-downs are lookups instead of full scans."""
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+
+MAX_QUERIES = 16
+
+
+class FileIndex:
+    def __init__(self, df, dates):
+        """Build the aggregates and row positions of one parsed file, dates are its parsed booking dates"""
+        self.length = len(df)
+        # Row positions of recent filtered and sorted details queries, dropped with the index
+        self.queries = OrderedDict()
+        # int64 cents, so the totals are exact
+        amounts = df['Betrag (€)'].to_numpy()
+        expense = amounts < 0
+        # Positions are sorted, so selecting them keeps the file's row order
+        self.expense_rows = np.flatnonzero(expense)
+        self.income_rows = np.flatnonzero(amounts > 0)
+        # The Income/Expense chart counts zero amounts as income
+        income_type = amounts >= 0
+        self.type_totals = {}
+        if (~income_type).any():
+            self.type_totals['Expense'] = int(-amounts[~income_type].sum())
+        if income_type.any():
+            self.type_totals['Income'] = int(amounts[income_type].sum())
+
+        self.category_rows = {}
+        if 'Kategorie' in df.columns:
+            # Group on the category codes, sorted categories give the names in order
+            codes, names = pd.factorize(df['Kategorie'], sort=True)
+            codes = codes[self.expense_rows]
+            counts = np.bincount(codes[codes >= 0], minlength=len(names))
+            order = self.expense_rows[codes >= 0][np.argsort(codes[codes >= 0], kind='stable')]
+            for name, count, rows in zip(names, counts, np.split(order, np.cumsum(counts)[:-1])):
+                if count:
+                    self.category_rows[name] = rows
+        self.category_totals = pd.Series(
+            {category: int(-amounts[rows].sum()) for category, rows in self.category_rows.items()},
+            dtype=np.int64,
+        )
+
+        expense_dates = dates[self.expense_rows]
+        self.expense_date_range = (expense_dates.min(), expense_dates.max())
+
+    def rows(self, kind, category=None):
+        """Row positions of a drill-down: 'all', 'expenses', 'income' or 'category'"""
+        if kind == 'expenses':
+            return self.expense_rows
+        if kind == 'income':
+            return self.income_rows
+        if kind == 'category':
+            return self.category_rows.get(category, np.array([], dtype=np.intp))
+        return np.arange(self.length)
+
+    def remember(self, key, positions):
+        self.queries[key] = positions
+        if len(self.queries) > MAX_QUERIES:
+            self.queries.popitem(last=False)
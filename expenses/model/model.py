@@ -1,55 +1,813 @@
+import numpy as np
 import pandas as pd
-import argparse
+import bisect
 import glob
+import io
+import itertools
+import json
 import os
-import yaml
-from ..classifier import Classifier
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from ..classifier import Classifier, KeywordIndex, RULES_PATH, load_categories, transaction_texts
+from ..llm import LLMClassifier
+from ..metrics import REGISTRY
+from . import reader, schema, writer
+from .store import SidecarStore
+from .shared import SharedVersion
+from .watcher import Watcher
+from .index import FileIndex
+from .fingerprints import FingerprintIndex, fingerprints, row_keys
 from datetime import datetime
 
 
+DETAIL_COLUMNS = ['Zahlungsempfänger*in', 'Verwendungszweck', 'Betrag (€)', 'Buchungsdatum', 'Kategorie']
+INCOME_DETAIL_COLUMNS = ['Zahlungspflichtige*r', 'Verwendungszweck', 'Betrag (€)', 'Buchungsdatum', 'Kategorie']
+CLASSIFICATION_CACHE = 'classifications.sqlite'
+FINGERPRINTS = 'fingerprints.sqlite'
+# Entries added one at a time, not yet written into their CSVs. Not in .cache, it is no derived data
+JOURNAL = '.journal.jsonl'
+# Sizes of the CSVs before a compaction appended to them, removed once the journal is emptied
+COMPACTING = '.journal.sizes'
+# Lock of the one process sharing the directory that parses the files missing from the manifest
+WARM_UP = 'warm-up'
+# Seconds to wait for more entries before the journal is compacted into the CSVs
+COMPACT_DELAY = 5.0
+STAGE_HELP = 'Time spent in Model load stages'
+LOADS_HELP = 'Files loaded, from the CSV or its sidecar'
+
+
+class FileEntries(Mapping):
+    """Read-only mapping from the files of a model to one field of their cache entries
+
+    A file is parsed when its value is first looked up, membership tests and iteration do not parse.
+    """
+    def __init__(self, model, field):
+        self._model = model
+        self._field = field
+
+    def __getitem__(self, csv_file):
+        if csv_file not in self._model._files:
+            raise KeyError(csv_file)
+        return self._model._entry(csv_file)[self._field]
+
+    def __contains__(self, csv_file):
+        return csv_file in self._model._files
+
+    def __iter__(self):
+        return iter(self._model.csv_files)
+
+    def __len__(self):
+        return len(self._model.csv_files)
+
+
 class Model:
-    def __init__(self, csv_dir):
+    def __init__(self, csv_dir, rebuild_cache=False, llm=None, max_memory_mb=None, shared=False):
+        """llm are LLMClassifier options, given to ask an LLM about transactions no keyword matches
+
+        With max_memory_mb only recently used files are kept in memory, others are dropped down
+        to their aggregates and parsed again when their rows are needed.
+
+        shared is for several processes serving the same directory: writes are locked and
+        counted on disk, and sync() picks up what the other processes wrote.
+        """
         self.csv_dir = csv_dir  # Store the csv_dir
         # Load categories configuration the same way as in classifier.py
-        with open('config/categories.yaml', 'r', encoding='utf-8') as f:
-            categories_yaml = yaml.safe_load(f)
-        categories_list = categories_yaml.get("Categories", [])
-        # Convert list of dicts to dict with category name as key
-        categories = {cat["name"]: {"keywords": cat["keywords"]} for cat in categories_list}
-        self.classifier = Classifier(categories)
+        self.rules_path = RULES_PATH
+        self._rules_stamp = self._stamp(self.rules_path)
+        categories = load_categories(self.rules_path)
+        # Files keyed by path, reused as long as mtime and size are unchanged. Entries without
+        # 'data' are stubs of files that were not parsed yet
+        self._cache = {}
+        self.max_memory = max_memory_mb * 2 ** 20 if max_memory_mb else None
+        # Files with data in memory, least recently used first, with their size in bytes
+        self._resident = OrderedDict()
+        self.data = FileEntries(self, 'data')
+        self.index = FileEntries(self, 'index')
+        self.dates = FileEntries(self, 'dates')
+        # Bumped whenever a file's data is (re)loaded or changed, used to key rendered figures
+        self._versions = itertools.count(1)
+        self._generations = itertools.count(1)
+        # Files changed in memory that save() has to write
+        self._dirty = set()
+        # Serializes entries, saves and journal compaction, which runs in a timer thread
+        self._lock = threading.RLock()
+        self.journal_path = os.path.join(csv_dir, JOURNAL)
+        # {csv_file: [rows]} journaled and appended in memory, but not to the CSV yet
+        self._journal_rows = {}
+        self._compact_timer = None
+        # Normalized frames persisted next to the CSVs so a restart does not parse them again
+        self.store = SidecarStore(csv_dir)
+        if rebuild_cache:
+            self.store.clear()
+        self.shared = SharedVersion(self.store.cache_dir, self._lock) if shared else None
+        # Owner file of every booking, so bookings in several files are only counted once
+        self.fingerprints = FingerprintIndex(os.path.join(self.store.cache_dir, FINGERPRINTS))
+        with self._exclusive():
+            self._undo_compaction()
+        # Version of the directory the listed files are from
+        self._seen = self.shared.current() if shared else 0
+        # Categories of texts seen in earlier uploads live next to the sidecars
+        fallback = LLMClassifier(categories, **llm) if llm is not None else None
+        self.classifier = Classifier(categories, cache_path=os.path.join(self.store.cache_dir, CLASSIFICATION_CACHE),
+                                     fallback=fallback)
+        if rebuild_cache and self.classifier.cache is not None:
+            self.classifier.cache.clear()
         self.refresh_data()
+        self.fingerprints.retain({os.path.basename(f): self._cache[f]['stamp'] for f in self.csv_files})
+        # Entries of a previous run that were not compacted yet
+        with self._exclusive():
+            self._replay_journal()
 
     def refresh_data(self):
-        """Refresh the list of CSV files and their data"""
-        csv_files = glob.glob(os.path.join(self.csv_dir, "*.csv"))
-        csv_files = sorted(csv_files,
-                            key=lambda f: pd.to_datetime(
-                                self._load_data(f)['Buchungsdatum'], format='%d.%m.%y', errors='coerce'
-                            ).min()
-                            )
+        """Refresh the list of CSV files
+
+        Only file metadata is read, a new or changed file is parsed the first time its data is used.
+        """
+        # Reloading a changed file would drop its journaled entries from memory
+        if self._journal_rows:
+            self.compact()
+        with REGISTRY.timer('expenses_model_stage_seconds', help=STAGE_HELP, stage='refresh'):
+            # Sorted by name first, files with the same first date keep that order on every platform
+            csv_files = sorted(glob.glob(os.path.join(self.csv_dir, "*.csv")))
+            manifest = self.store.manifest()
+            entries = {csv_file: self._stub_or_cached(csv_file, manifest) for csv_file in csv_files}
+            # Drop cache entries of files that disappeared from the directory
+            for csv_file in list(self._cache):
+                if csv_file not in entries:
+                    del self._cache[csv_file]
+                    self._resident.pop(csv_file, None)
+                    self.store.remove(csv_file)
+                    self._forget(csv_file)
+            self._set_files(sorted(csv_files, key=lambda f: self._sort_key(entries[f])))
+
+    def _set_files(self, csv_files):
+        """List csv_files, in this order, as the files of the model"""
         self.csv_files = csv_files
-        self.data = {csv_file: self._load_data(csv_file) for csv_file in csv_files}
+        self._files = set(csv_files)
+        # Tells pages whether their list of files is outdated
+        self.generation = next(self._generations)
+        # The consolidated ledger and keyword index are rebuilt lazily on the next access
+        self._ledger = None
+        self._keywords = None
+
+    def _sort_key(self, entry):
+        """Files are ordered by their first booking date, files without dates go last
+
+        Files whose dates are not known before parsing them are ordered by the first rows of
+        the file, see _stub_or_cached, and go after known files with the same date.
+        """
+        first_date = entry['date_range'][0]
+        return (pd.Timestamp.max if pd.isnull(first_date) else first_date, not entry['known'])
+
+    @staticmethod
+    def _stamp(path):
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _stub_or_cached(self, csv_file, manifest):
+        """Return the cache entry of a CSV file, a stub without data if it is new or changed
+
+        The date range of a stub comes from the sidecar manifest, if it is up to date. Otherwise
+        its first date is the earliest in the first few KB of the file, until it is parsed.
+        """
+        stamp = self._stamp(csv_file)
+        entry = self._cache.get(csv_file)
+        known = manifest.get(os.path.basename(csv_file))
+        known = known if known is not None and tuple(known['stamp']) == stamp else None
+        # A stub whose file another process parsed meanwhile gets its dates from the manifest
+        if entry is None or entry['stamp'] != stamp or (known is not None and not entry['known']):
+            if known is not None:
+                date_range = [pd.Timestamp(date) if date else pd.NaT for date in known.get('date_range') or (None, None)]
+            else:
+                date_range = [reader.first_date(csv_file), pd.NaT]
+            entry = {
+                'stamp': stamp,
+                'date_range': tuple(date_range),
+                'known': known is not None,
+                'version': next(self._versions),
+            }
+            self._cache[csv_file] = entry
+            self._resident.pop(csv_file, None)
+        return entry
+
+    def _entry(self, csv_file):
+        """Return the cache entry of a listed file with its data, parsing the file on first use
+
+        The file is parsed outside the model lock, like in ingest(), and installed under it.
+        """
+        entry = self._cache[csv_file]
+        while 'data' not in entry:
+            stub = entry
+            if stub.get('evicted'):
+                REGISTRY.inc('expenses_model_reloads_total',
+                             help='Files parsed again after they were evicted from memory')
+            loaded = self._load_cached(csv_file, stub['version'], install=False)
+            with self._lock:
+                entry = self._cache[csv_file]
+                if entry is not stub:
+                    # Parsed or swapped by another thread meanwhile, a new stub is parsed again
+                    continue
+                if 'summary' in stub and loaded['stamp'] == stub['stamp']:
+                    loaded['summary'] = stub['summary']
+                self._cache[csv_file] = entry = loaded
+                self._claim(csv_file, entry)
+                self._track(csv_file, entry)
+                if self._sort_key(entry) != self._sort_key(stub):
+                    self._set_files(sorted(self.csv_files, key=lambda f: self._sort_key(self._cache[f])))
+            return entry
+        if self.max_memory is not None:
+            with self._lock:
+                if csv_file in self._resident:
+                    self._resident.move_to_end(csv_file)
+        return entry
+
+    def _load_cached(self, csv_file, version=None, install=True):
+        """Parse a CSV file, or read its sidecar, into a new cache entry"""
+        stamp = self._stamp(csv_file)
+        with REGISTRY.timer('expenses_model_stage_seconds', help=STAGE_HELP, stage='sidecar'):
+            stored = self.store.load(csv_file, stamp, zero_copy=self.shared is not None)
+        if stored is not None:
+            REGISTRY.inc('expenses_model_loads_total', help=LOADS_HELP, source='sidecar')
+            return self._new_entry(csv_file, stamp, stored[0], save=False, version=version, install=install)
+        REGISTRY.inc('expenses_model_loads_total', help=LOADS_HELP, source='csv')
+        return self._new_entry(csv_file, stamp, self._load_data(csv_file), version=version, install=install)
+
+    def changes(self):
+        """Compare the directory with the listed files, returns ({new or changed file: stamp}, [removed files])"""
+        stamps = {}
+        for csv_file in glob.glob(os.path.join(self.csv_dir, "*.csv")):
+            try:
+                stamps[csv_file] = self._stamp(csv_file)
+            except OSError:
+                # Removed since the directory was listed
+                pass
+        with self._lock:
+            changed = {f: stamp for f, stamp in stamps.items()
+                       if f not in self._cache or self._cache[f]['stamp'] != stamp}
+            return changed, [f for f in self._cache if f not in stamps]
+
+    def ingest(self, changed, removed=()):
+        """Swap changed files into the model and drop removed ones, see watcher.py
+
+        changed are files whose new content is parsed before anything is swapped, so callbacks
+        keep using the old data meanwhile and never wait for a parse. Files with changes in
+        memory that are not saved yet keep them until then, see save() and compact().
+        Returns the files that could not be read.
+        """
+        entries = {}
+        failed = []
+        for csv_file in changed:
+            try:
+                entries[csv_file] = self._load_cached(csv_file, install=False)
+            except Exception as e:
+                print(f"Could not read {csv_file}: {e}")
+                failed.append(csv_file)
+        with self._lock:
+            for csv_file, entry in entries.items():
+                current = self._cache.get(csv_file)
+                if current is not None and (current['stamp'] == entry['stamp'] or csv_file in self._dirty
+                                            or csv_file in self._journal_rows):
+                    continue
+                self._cache[csv_file] = entry
+                self._resident.pop(csv_file, None)
+                self._claim(csv_file, entry)
+                self._track(csv_file, entry)
+            for csv_file in removed:
+                if csv_file in self._cache and not os.path.exists(csv_file):
+                    del self._cache[csv_file]
+                    self._resident.pop(csv_file, None)
+                    self._dirty.discard(csv_file)
+                    self.store.remove(csv_file)
+                    self._forget(csv_file)
+            if entries or removed:
+                REGISTRY.inc('expenses_model_ingested_total', len(entries) + len(removed),
+                             help='Files added, changed or removed on disk and picked up while running')
+                self._set_files(sorted(sorted(self._cache), key=lambda f: self._sort_key(self._cache[f])))
+        return failed
+
+    def watch(self, interval=2.0):
+        """Pick up CSVs other programs add, change or remove in a background thread, returns it"""
+        watcher = Watcher(self, interval)
+        watcher.start()
+        return watcher
+
+    def load_all(self):
+        """Parse every file that was not used yet"""
+        for csv_file in list(self.csv_files):
+            self._entry(csv_file)
+
+    def warm_up(self):
+        """Parse the files whose dates are not in the manifest in a background thread
+
+        Until then they are ordered by the dates of their first rows, see reader.first_date.
+        In a shared directory only the process that gets here first parses them, the others
+        read the manifest and sidecars it leaves on their next sync().
+        """
+        unknown = [csv_file for csv_file in self.csv_files if not self._cache[csv_file]['known']]
+        if not unknown:
+            return None
+        claim = self.shared.try_lock(WARM_UP) if self.shared is not None else None
+        if self.shared is not None and claim is None:
+            return None
+
+        def run():
+            try:
+                for csv_file in unknown:
+                    if csv_file in self._files:
+                        self._entry(csv_file)
+            finally:
+                if claim is not None:
+                    claim.close()
+                    self._changed()
+
+        thread = threading.Thread(target=run, name='expenses-warm-up', daemon=True)
+        thread.start()
+        return thread
+
+    def _new_entry(self, csv_file, stamp, df, save=True, version=None, install=True):
+        """Build and cache the entry of a parsed file, and write its sidecar unless it came from there
+
+        A file parsed on first use keeps the version of its stub, nothing it rendered before can be stale.
+        Without install the entry is only returned, see ingest().
+        """
+        with REGISTRY.timer('expenses_model_stage_seconds', help=STAGE_HELP, stage='dates'):
+            dates = self._parse_dates(df)
+        if save:
+            self._save_sidecar(csv_file, stamp, df, dates)
+        with REGISTRY.timer('expenses_model_stage_seconds', help=STAGE_HELP, stage='index'):
+            index = FileIndex(df, dates)
+        entry = {
+            'stamp': stamp,
+            'data': df,
+            'dates': dates,
+            'date_range': (dates.min(), dates.max()),
+            'known': True,
+            'index': index,
+            # Hashed when the file is first looked up in the fingerprint index, see _claim
+            'keys': None,
+            'fingerprints': None,
+            'duplicates': np.array([], dtype=np.intp),
+            'version': version or next(self._versions),
+        }
+        if install:
+            self._cache[csv_file] = entry
+            self._claim(csv_file, entry)
+            self._track(csv_file, entry)
+        return entry
+
+    def _claim(self, csv_file, entry, changed=False, appended=0):
+        """Look up the rows of an installed entry in the fingerprint index, marking those of other files
+
+        changed is for data changed in memory since the file was read or written, appended
+        the number of rows added at its end since the last lookup, only those are looked up.
+        """
+        name = os.path.basename(csv_file)
+        with self._lock, REGISTRY.timer('expenses_model_stage_seconds', help=STAGE_HELP, stage='duplicates'):
+            if appended and entry['keys'] is not None:
+                keys = row_keys(entry['data'], entry['dates'], start=len(entry['data']) - appended)
+                entry['fingerprints'] = np.concatenate([entry['fingerprints'], fingerprints(keys, entry['keys'])])
+                entry['keys'] = np.concatenate([entry['keys'], keys])
+                duplicates = self.fingerprints.extend(name, entry['fingerprints'][-appended:])
+                if len(duplicates):
+                    duplicates += len(entry['keys']) - appended
+                    entry['duplicates'] = np.concatenate([entry['duplicates'], duplicates])
+                    entry.pop('summary', None)
+                    self._ledger = None
+                return
+            if entry['keys'] is None or (changed and not appended):
+                if not changed and self.fingerprints.unique(name, entry['stamp']):
+                    # Indexed before with the same content, none of its rows are in other files
+                    return
+                entry['keys'] = row_keys(entry['data'], entry['dates'])
+                entry['fingerprints'] = fingerprints(entry['keys'])
+            duplicates, released = self.fingerprints.add(name, entry['stamp'], entry['fingerprints'])
+            if not np.array_equal(duplicates, entry['duplicates']):
+                entry['duplicates'] = duplicates
+                entry.pop('summary', None)
+                self._ledger = None
+            if released:
+                self._recheck_duplicates()
+
+    def _forget(self, csv_file):
+        """Release the bookings of a removed file"""
+        with self._lock:
+            if self.fingerprints.remove(os.path.basename(csv_file)):
+                self._recheck_duplicates()
+
+    def _recheck_duplicates(self):
+        """Look up the files with duplicates again after bookings were released, one of them takes them over"""
+        for csv_file, entry in list(self._cache.items()):
+            if not len(entry.get('duplicates', ())):
+                continue
+            if 'data' in entry:
+                self._claim(csv_file, entry)
+            else:
+                # Evicted, the summary is built again from the file
+                entry.pop('summary', None)
+                entry['duplicates'] = np.array([], dtype=np.intp)
+
+    def _track(self, csv_file, entry):
+        """Count a parsed file against the memory budget and evict the least recently used others"""
+        if self.max_memory is None:
+            return
+        with self._lock:
+            self._resident[csv_file] = int(entry['data'].memory_usage(deep=True).sum()) + entry['dates'].nbytes
+            self._resident.move_to_end(csv_file)
+            self._evict()
+
+    def _evict(self):
+        """Drop the data of least recently used files until the resident ones fit the budget
+
+        The most recently used file always stays, as do files with changes not written yet.
+        Their aggregates are kept, see _summary.
+        """
+        while sum(self._resident.values()) > self.max_memory:
+            pinned = set(self._dirty) | set(self._journal_rows) | {next(reversed(self._resident))}
+            csv_file = next((f for f in self._resident if f not in pinned), None)
+            if csv_file is None:
+                break
+            summary = self._summary(csv_file, monthly=True)
+            entry = self._cache[csv_file]
+            self._cache[csv_file] = {
+                'stamp': entry['stamp'],
+                'date_range': entry['date_range'],
+                'known': True,
+                'version': entry['version'],
+                'summary': summary,
+                'duplicates': entry['duplicates'],
+                'evicted': True,
+            }
+            del self._resident[csv_file]
+            REGISTRY.inc('expenses_model_evictions_total', help='Files whose data was dropped from memory')
+        REGISTRY.set('expenses_model_resident_bytes', sum(self._resident.values()),
+                     help='Approximate size of the file data held in memory')
+        REGISTRY.set('expenses_model_resident_files', len(self._resident), help='Files with data in memory')
+
+    def _summary(self, csv_file, monthly=False):
+        """Aggregates of a file, they stay in memory when the file's data is evicted
+
+        Monthly income, expense and category totals are only computed when asked for.
+        """
+        entry = self._cache[csv_file]
+        if 'summary' not in entry or (monthly and 'monthly' not in entry['summary']):
+            entry = self._entry(csv_file)
+            index = entry['index']
+            summary = entry.setdefault('summary', {
+                'type_totals': index.type_totals,
+                'category_totals': index.category_totals,
+                'expense_date_range': index.expense_date_range,
+            })
+            if monthly and 'monthly' not in summary:
+                frame = self._dated(entry['data'], entry['dates'], entry['duplicates'])
+                summary['monthly'] = self._totals(frame, 'MS')
+                summary['monthly_categories'] = self._category_totals(frame, 'MS')
+        return entry['summary']
+
+    def _save_sidecar(self, csv_file, stamp, df, dates):
+        with REGISTRY.timer('expenses_model_stage_seconds', help=STAGE_HELP, stage='sidecar_write'):
+            self.store.save(csv_file, stamp, df, date_range=[
+                None if pd.isnull(date) else date.isoformat() for date in (dates.min(), dates.max())
+            ])
+
+    def _write(self, csv_file, df):
+        """Write a frame as CSV through a temporary file, so a crash never leaves a truncated file"""
+        tmp = csv_file + '.tmp'
+        with REGISTRY.timer('expenses_model_stage_seconds', help=STAGE_HELP, stage='write'):
+            with open(tmp, 'w', encoding='utf-8', newline='') as f:
+                schema.to_export(df).to_csv(f, index=False, sep=';')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, csv_file)
+
+    def _written(self, csv_file):
+        """Stamp the cache entry and sidecar of a file this model just wrote, its data in memory is what it holds"""
+        entry = self._cache[csv_file]
+        entry['stamp'] = self._stamp(csv_file)
+        self._save_sidecar(csv_file, entry['stamp'], entry['data'], entry['dates'])
+        self._claim(csv_file, entry)
+        self._dirty.discard(csv_file)
+        self._changed()
+
+    def _register(self, csv_file, df):
+        """Add a file this model just wrote from its in-memory DataFrame, without reading the directory"""
+        entry = self._new_entry(csv_file, self._stamp(csv_file), df)
+        csv_files = [f for f in self.csv_files if f != csv_file]
+        # Ties are in name order, like the files listed by refresh_data
+        keys = [(self._sort_key(self._cache[f]), f) for f in csv_files]
+        csv_files.insert(bisect.bisect_right(keys, (self._sort_key(entry), csv_file)), csv_file)
+        self._set_files(csv_files)
+        self._changed()
+
+    def _exclusive(self):
+        """Lock held while files are written, across processes if the directory is shared"""
+        return self.shared.lock() if self.shared is not None else self._lock
+
+    def _changed(self):
+        """Count a write, so other processes sharing the directory pick it up"""
+        if self.shared is None:
+            return
+        version = self.shared.bump()
+        # If another process wrote meanwhile, the next sync() still has to pick that up
+        if version == self._seen + 1:
+            self._seen = version
+
+    def sync(self):
+        """Pick up the files other processes sharing the directory wrote, returns whether there were any
+
+        Only the changed files are dropped from memory, they are read from the sidecar their
+        writer left on next use.
+        """
+        if self.shared is None or self.shared.current() == self._seen:
+            return False
+        with self._lock:
+            version = self.shared.current()
+            if version == self._seen:
+                return False
+            self._seen = version
+            REGISTRY.inc('expenses_model_syncs_total', help='Refreshes after other processes wrote files')
+            self.store.manifest(reload=True)
+            self.refresh_data()
+            return True
+
+    def _parse_dates(self, df):
+        """Parse the booking dates of a DataFrame once, NaT where unknown"""
+        if 'Buchungsdatum' not in df.columns:
+            return pd.DatetimeIndex([pd.NaT] * len(df))
+        if pd.api.types.is_datetime64_any_dtype(df['Buchungsdatum']):
+            return pd.DatetimeIndex(df['Buchungsdatum'])
+        return pd.DatetimeIndex(pd.to_datetime(df['Buchungsdatum'], format=schema.DATE_FORMAT, errors='coerce'))
+
+    @property
+    def ledger(self):
+        """All files in one DataFrame indexed by booking date, with the source file in 'Quelle'
+
+        Rows without a valid booking date are left out. The ledger is built on first access
+        after the data changed. With a memory budget it is built again on every access and
+        not kept, it would keep the data of evicted files alive, see period().
+        """
+        if self.max_memory is not None:
+            return self._build_ledger()
+        return self._aggregated()
+
+    def _aggregated(self):
+        """The ledger the aggregates are computed from, kept until the data changes
+
+        With a memory budget it only has the amounts and categories of the rows.
+        """
+        if self._ledger is None:
+            # Under the lock, files swapped in meanwhile would be missing from it
+            with self._lock, REGISTRY.timer('expenses_model_stage_seconds', help=STAGE_HELP, stage='ledger'):
+                if self._ledger is None:
+                    self._ledger = self._build_ledger(dated=self.max_memory is not None)
+        return self._ledger
+
+    def _build_ledger(self, start=None, end=None, dated=False):
+        """The ledger rows booked between start and end, dated only has the amounts and categories
+
+        Files whose known dates are all outside the range are not read.
+        """
+        if self.max_memory is None:
+            # Parsed first, so the files are in their final order
+            self.load_all()
+        csv_files = list(self.csv_files)
+        ranged = start is not None or end is not None
+        frames = []
+        sources = []
+        # One file at a time, under a memory budget the others may be evicted meanwhile
+        for source, csv_file in enumerate(csv_files):
+            # With no rows in the range, the last file still gives the ledger its columns
+            if ranged and not self._overlaps(csv_file, start, end) and (frames or source < len(csv_files) - 1):
+                continue
+            entry = self._entry(csv_file)
+            if dated:
+                frame = self._dated(entry['data'], entry['dates'], entry['duplicates'])
+            else:
+                frame = entry['data'].set_axis(entry['dates'], axis=0)
+                keep = frame.index.notna()
+                if len(entry['duplicates']):
+                    # Counted in the file they were first seen in
+                    keep[entry['duplicates']] = False
+                frame = frame[keep]
+            if ranged:
+                frame = frame.sort_index(kind='stable').loc[start:end]
+            frames.append(frame)
+            sources.append(source)
+        if frames:
+            ledger = schema.concat(frames)
+            codes = np.repeat(sources, [len(df) for df in frames])
+            ledger['Quelle'] = pd.Categorical.from_codes(codes, csv_files)
+        else:
+            ledger = pd.DataFrame({'Betrag (€)': [], 'Kategorie': [], 'Quelle': []},
+                                  index=pd.DatetimeIndex([]))
+        ledger = ledger[ledger.index.notna()].sort_index(kind='stable')
+        ledger.index.name = 'Datum'
+        return ledger
+
+    def _overlaps(self, csv_file, start, end):
+        """Whether a file may have rows between start and end, files whose dates are not known may"""
+        entry = self._cache[csv_file]
+        first, last = entry['date_range']
+        if not entry['known'] or pd.isnull(first) or pd.isnull(last):
+            return True
+        # Positions like in a ledger of just its first and last date, start and end may be partial dates
+        after_start, up_to_end = pd.DatetimeIndex([first, last]).slice_locs(start, end)
+        return after_start < 2 and up_to_end > 0
+
+    @property
+    def keywords(self):
+        """KeywordIndex over the distinct texts of all files, with the text of every row per file
+
+        Built on first access after the data changed, as (index, {csv_file: text positions}).
+        Files without the text columns are left out.
+        """
+        if self._keywords is None:
+            with self._lock, REGISTRY.timer('expenses_model_stage_seconds', help=STAGE_HELP, stage='keywords'):
+                if self._keywords is None:
+                    self._keywords = self._build_keywords()
+        return self._keywords
+
+    def _build_keywords(self):
+        # Position of every distinct text, in order of appearance. Files are read one at a time
+        # and only their text positions kept, under a memory budget the others may be evicted meanwhile
+        positions = {}
+        texts = {}
+        for csv_file in list(self.csv_files):
+            df = self.data[csv_file]
+            if 'Zahlungsempfänger*in' not in df.columns or 'Verwendungszweck' not in df.columns:
+                continue
+            codes, uniques = pd.factorize(transaction_texts(df['Zahlungsempfänger*in'], df['Verwendungszweck']))
+            known = np.fromiter((positions.setdefault(text, len(positions)) for text in uniques),
+                                dtype=np.intp, count=len(uniques))
+            texts[csv_file] = known[codes]
+        return KeywordIndex(list(positions)), texts
+
+    def reload_categories(self):
+        """Apply edits of the category rules to the loaded files, returns the files that changed
+
+        Only rows whose text contains a keyword that was added, removed or moved to another
+        category, or whose category was removed, are classified again. The new categories are
+        patched into the CSV rows that hold them, see writer.py, and the aggregates of changed
+        files rebuilt. Does nothing while the rules file is unchanged, see watcher.py.
+        """
+        # Under the lock, so that the rules are only applied once if several threads look at them
+        with self._lock:
+            stamp = self._stamp(self.rules_path)
+            if stamp == self._rules_stamp:
+                return []
+            self._rules_stamp = stamp
+            with REGISTRY.timer('expenses_model_stage_seconds', help=STAGE_HELP, stage='reclassify'):
+                try:
+                    categories = load_categories(self.rules_path)
+                except Exception as e:
+                    print(f"Error loading {self.rules_path}, keeping the previous rules: {e}")
+                    return []
+                removed = [name for name in self.classifier.categories if name not in categories]
+                keywords = self.classifier.set_categories(categories)
+                index, texts = self.keywords
+                generation = self.generation
+                if keywords is not None:
+                    affected_texts = np.zeros(len(index.texts), dtype=bool)
+                    for keyword in keywords:
+                        affected_texts[index.matches(keyword)] = True
+                # Categories of the distinct texts, each classified once when a file first needs it
+                categories = np.empty(len(index.texts), dtype=object)
+                classified = np.zeros(len(index.texts), dtype=bool)
+                changed = []
+                # One file at a time, under a memory budget the others may be evicted meanwhile
+                for csv_file, codes in texts.items():
+                    if keywords is not None and not removed and not affected_texts[codes].any():
+                        # Nothing to do, the file is not even loaded
+                        continue
+                    df = self.data[csv_file]
+                    if 'Kategorie' not in df.columns:
+                        continue
+                    rows = np.ones(len(df), dtype=bool) if keywords is None else affected_texts[codes]
+                    rows |= df['Kategorie'].isin(removed).to_numpy()
+                    if 'Umsatztyp' in df.columns:
+                        # The 'Ausgleich' summary rows are not bank transactions
+                        rows &= (df['Umsatztyp'] != 'Zusammenfassung').to_numpy()
+                    rows = np.flatnonzero(rows)
+                    if not len(rows):
+                        continue
+                    positions = np.unique(codes[rows])
+                    positions = positions[~classified[positions]]
+                    if len(positions):
+                        categories[positions] = self.classifier.classify_indexed(index, positions)
+                        classified[positions] = True
+                    new = categories[codes[rows]]
+                    different = new != df['Kategorie'].iloc[rows].astype(object).to_numpy()
+                    if not different.any():
+                        continue
+                    self._set_categories(csv_file, rows[different], new[different])
+                    REGISTRY.inc('expenses_model_reclassified_rows_total', int(different.sum()),
+                                 help='Rows whose category changed after a rules edit')
+                    changed.append(csv_file)
+                # Files whose CSV could not be written are tried once more
+                self.save()
+                if self.generation == generation:
+                    # Only categories changed, the texts and their keyword lookups are still valid
+                    self._keywords = (index, texts)
+            if changed:
+                print(f"Categories of {len(changed)} files changed after editing {self.rules_path}")
+            return changed
+
+    def _set_categories(self, csv_file, rows, categories):
+        """Change the categories of rows of a file in memory and in its CSV, see save()"""
+        with self._exclusive():
+            schema.assign(self.data[csv_file], 'Kategorie', rows, categories)
+            # Marked dirty until the CSV is written, so that it is not evicted before
+            self.update_index(csv_file)
+            self._save_file(csv_file)
+
+    def period(self, start=None, end=None):
+        """Ledger rows booked between start and end (inclusive), a binary search on the sorted index
+
+        With a memory budget only the files with rows in the range are read, one at a time.
+        """
+        if self.max_memory is not None:
+            return self._build_ledger(start, end)
+        return self.ledger.loc[start:end]
+
+    def totals(self, freq='MS', start=None, end=None):
+        """Income and expense per period as positive cents, e.g. freq='MS' for months or 'W' for weeks"""
+        if self._from_summaries(freq, start, end):
+            parts = [self._summary(csv_file, monthly=True)['monthly'] for csv_file in self.csv_files]
+            parts = [part for part in parts if not part.empty]
+            if parts:
+                return pd.concat(parts).groupby(level=0).sum().asfreq(freq, fill_value=0)
+        return self._totals(self._aggregated().loc[start:end], freq)
+
+    def category_totals_over_time(self, freq='MS', start=None, end=None):
+        """Expenses per period and category as positive cents, one column per category"""
+        if self._from_summaries(freq, start, end):
+            parts = [self._summary(csv_file, monthly=True)['monthly_categories'] for csv_file in self.csv_files]
+            parts = [part for part in parts if len(part)]
+            totals = pd.concat(parts).groupby(level=[0, 1]).sum() if parts else pd.Series([], dtype=np.int64)
+        else:
+            totals = self._category_totals(self._aggregated().loc[start:end], freq)
+        totals = totals.unstack(fill_value=0) if len(totals) else pd.DataFrame(index=pd.DatetimeIndex([], name='Datum'))
+        # The ledger's categories are in order of appearance
+        return totals[sorted(totals.columns)]
 
-    def classify_and_save_file(self, df_raw, filename=None):
-        """Classify a DataFrame and save it to the csv directory"""
+    def _from_summaries(self, freq, start, end):
+        """Whether an aggregate over all time is summed from the per-file summaries instead of the ledger
+
+        Only with a memory budget, where building the ledger would need every file in memory.
+        """
+        return self.max_memory is not None and freq == 'MS' and start is None and end is None
+
+    @staticmethod
+    def _dated(df, dates, duplicates=()):
+        """Amounts and categories of a file indexed by booking date, like its rows in the ledger"""
+        columns = {'Betrag (€)': df['Betrag (€)'].to_numpy()}
+        if 'Kategorie' in df.columns:
+            columns['Kategorie'] = df['Kategorie'].to_numpy()
+        frame = pd.DataFrame(columns, index=dates.rename('Datum'))
+        keep = frame.index.notna()
+        if len(duplicates):
+            keep[duplicates] = False
+        return frame[keep]
+
+    @staticmethod
+    def _totals(frame, freq):
+        amounts = frame['Betrag (€)']
+        return pd.DataFrame({
+            'Income': amounts.clip(lower=0).resample(freq).sum(),
+            'Expense': -amounts.clip(upper=0).resample(freq).sum(),
+        })
+
+    @staticmethod
+    def _category_totals(frame, freq):
+        """Expenses per (period, category), as a Series"""
+        if 'Kategorie' not in frame.columns:
+            return pd.Series([], dtype=np.int64)
+        expenses = frame[frame['Betrag (€)'] < 0]
+        return -expenses.groupby([pd.Grouper(freq=freq), 'Kategorie'], observed=True)['Betrag (€)'].sum()
+
+    def date_range(self):
+        """First and last booking date over all files, NaT if there are no dates"""
+        ranges = [
+            entry['date_range'] for entry in
+            (self._cache[f] if self._cache[f]['known'] else self._entry(f) for f in list(self.csv_files))
+        ]
+        firsts = [first for first, _ in ranges if pd.notnull(first)]
+        lasts = [last for _, last in ranges if pd.notnull(last)]
+        return (min(firsts), max(lasts)) if firsts else (pd.NaT, pd.NaT)
+
+    def classify_and_save_file(self, df_raw, filename=None, progress=None):
+        """Classify a DataFrame and save it to the csv directory
+
+        progress is called as progress(stage, rows done, rows total) while the rows are
+        classified in chunks and before writing, an exception it raises aborts before anything
+        is written. See uploads.py.
+        """
         # Use the same simple logic as classifier.py
         df = df_raw.copy()
         
         # Apply classification using the same logic as classifier.py
-        categories = []
-        for _, row in df.iterrows():
-            if any(column not in row for column in ['Zahlungsempfänger*in', 'Verwendungszweck']):
-                categories.append(None)
-                continue
-            line_text = " ".join(str(item) for item in row[["Zahlungsempfänger*in", 'Verwendungszweck']])
-            try:
-                category = self.classifier.classify(line_text)
-                categories.append(category)
-            except ValueError as e:
-                print(e)
-                categories.append(None)
-        
-        df['Kategorie'] = categories
+        df['Kategorie'] = self._classify(df, progress)
+        df = self._convert_betrag_column(df)
         
         # Generate output filename if not provided
         if filename is None:
@@ -63,20 +821,252 @@ class Model:
         
         # Save the classified file
         output_path = os.path.join(self.csv_dir, filename)
-        df.to_csv(output_path, index=False, encoding='utf-8', sep=';')
-        self.refresh_data()
+        if progress is not None:
+            progress('writing', len(df), len(df))
+        with self._exclusive():
+            self._write(output_path, df)
+            self._register(output_path, schema.compact(self._preprocess_income(df)))
         return output_path
 
+    def _classify(self, df, progress=None):
+        """Categories of the rows of a bank export, with a progress report per chunk of distinct texts"""
+        if progress is None:
+            return self.classifier.classify_frame(df)
+        progress('classifying', 0, len(df))
+        categories = self.classifier.classify_frame(df, lambda rows: progress('classifying', rows, len(df)))
+        progress('classifying', len(df), len(df))
+        return categories
+
+    def classify_and_save_upload(self, content, filename=None, progress=None):
+        """Parse an uploaded bank export from its raw bytes, then classify and save it"""
+        return self.classify_and_save_file(reader.read_csv(io.BytesIO(content)), filename, progress)
+
     def add_classified_file(self, df, filename):
         """Save a new classified DataFrame to the csv directory"""
         output_path = os.path.join(self.csv_dir, filename)
-        df.to_csv(output_path, index=False, encoding='utf-8', sep=';')
-        self.refresh_data()
+        df = self._convert_betrag_column(df.copy())
+        with self._exclusive():
+            self._write(output_path, df)
+            self._register(output_path, schema.compact(self._preprocess_income(df)))
         return output_path
 
     def save(self):
-        for csv_file, df in self.data.items():
-            df.to_csv(csv_file, index=False, encoding='utf-8', sep=';')
+        """Write the files changed in memory, see update_index, into their CSVs, returns them
+
+        Only the changed cells are written, into the CSV rows that hold them, see _patch.
+        Changes of a file that changed on disk meanwhile are dropped, its new content is read instead.
+        """
+        with self._exclusive():
+            dirty = [csv_file for csv_file in self.csv_files if csv_file in self._dirty]
+            for csv_file in dirty:
+                self._save_file(csv_file)
+            if dirty and self.max_memory is not None:
+                # Saved files can be evicted again
+                self._evict()
+            return dirty
+
+    def _save_file(self, csv_file):
+        """Write the changes in memory of one file into its CSV and restamp its sidecar"""
+        if csv_file in self._journal_rows:
+            # Its journaled rows go into the CSV first, so that its rows line up with those in memory
+            self.compact()
+        if self._stamp(csv_file) != self._cache[csv_file]['stamp']:
+            print(f"{csv_file} changed on disk, dropping its changes in memory")
+            self._reread(csv_file)
+            return
+        try:
+            with REGISTRY.timer('expenses_model_stage_seconds', help=STAGE_HELP, stage='write'):
+                if not self._patch(csv_file):
+                    print(f"The rows of {csv_file} do not line up with the file, writing it as a whole")
+                    self._write(csv_file, self.data[csv_file])
+        except (OSError, UnicodeError) as e:
+            # Stays dirty, so it is kept in memory and written on the next save()
+            print(f"Could not write the changes into {csv_file}: {e}")
+            return
+        self._written(csv_file)
+
+    def _patch(self, csv_file):
+        """Write the cells of a file changed in memory into the CSV rows that hold them
+
+        The CSV is read again and compared with the data in memory. Both have its rows in the
+        same order, except for the 'Ausgleich' rows that are merged into one row in memory,
+        those are left as they are. Returns False if the rows do not line up.
+        """
+        if reader.sniff(csv_file).columns is None:
+            return False
+        on_disk = schema.compact(self._convert_betrag_column(reader.read_csv(csv_file)))
+        merged = self._merged(on_disk)
+        on_disk = on_disk[~merged]
+        df = self.data[csv_file]
+        df = df[~self._merged(df)]
+        if len(df) != len(on_disk):
+            return False
+        # Numbers of the rows in the CSV, counted like writer.patch_rows does
+        numbers = np.flatnonzero(~merged)
+        changes = {}
+        for column in df.columns.intersection(on_disk.columns):
+            new = df[column].astype(object).to_numpy()
+            old = on_disk[column].astype(object).to_numpy()
+            rows = np.flatnonzero(~((new == old) | (pd.isnull(new) & pd.isnull(old))))
+            if not len(rows):
+                continue
+            values = schema.to_export(df[[column]].iloc[rows])[column]
+            for row, value in zip(numbers[rows].tolist(), values):
+                changes.setdefault(row, {})[column] = '' if pd.isnull(value) else str(value)
+        writer.patch_rows(csv_file, changes)
+        return True
+
+    def add_entry(self, csv_file, entry):
+        """Append one booking to a file, entry maps columns to values as entered
+
+        Dates are dd.mm.yy, the amount is a number or German notation text. The entry is
+        appended to the journal and to the file in memory right away, and as a row of text to
+        the CSV later by compact(), together with other entries added meanwhile. In a shared
+        directory it is appended to the CSV right away, other processes only see written files.
+        """
+        row = self._entry_row(entry)
+        with self._exclusive():
+            # Append to the file as other processes last wrote it
+            self.sync()
+            if csv_file not in self._cache:
+                raise KeyError(f"Unknown file {csv_file}")
+            try:
+                writer.format_rows(csv_file, [row], list(self.data[csv_file].columns))
+            except UnicodeEncodeError as e:
+                raise ValueError(f"The entry cannot be stored in the encoding of {os.path.basename(csv_file)}: {e}")
+            with open(self.journal_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({'file': os.path.basename(csv_file), 'row': row}, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._append(csv_file, row)
+            if self.shared is not None:
+                self.compact()
+            else:
+                self._schedule_compaction()
+
+    def _entry_row(self, entry):
+        """An entry as the text its CSV row would contain"""
+        row = {column: str(value).strip() for column, value in entry.items() if value is not None and str(value).strip()}
+        amount = entry.get('Betrag (€)')
+        if isinstance(amount, (int, float)):
+            row['Betrag (€)'] = schema.format_cents(schema.to_cents([amount]))[0]
+        for column in ['Buchungsdatum', 'Betrag (€)', 'Kategorie']:
+            if column not in row:
+                raise ValueError(f"{column} is required")
+        for column in schema.DATE_COLUMNS:
+            if column in row and pd.isnull(pd.to_datetime(row[column], format=schema.DATE_FORMAT, errors='coerce')):
+                raise ValueError(f"{column} must be a date like 31.12.24, got '{row[column]}'")
+        if pd.isnull(pd.to_numeric(row['Betrag (€)'].replace('.', '').replace(',', '.'), errors='coerce')):
+            raise ValueError(f"Betrag (€) must be an amount like -12,50, got '{row['Betrag (€)']}'")
+        return row
+
+    def _append(self, csv_file, row):
+        """Append a row in CSV text form to a file in memory"""
+        df = self.data[csv_file]
+        values = {column: value for column, value in row.items() if column in df.columns}
+        if 'Betrag (€)' in values:
+            values['Betrag (€)'] = schema.parse_cents([values['Betrag (€)']])[0]
+        for column in schema.DATE_COLUMNS:
+            if column in values:
+                values[column] = pd.to_datetime(values[column], format=schema.DATE_FORMAT, errors='coerce')
+        self._cache[csv_file]['data'] = schema.append_row(df, values)
+        self.update_index(csv_file, dirty=False, appended=1)
+        self._journal_rows.setdefault(csv_file, []).append(row)
+
+    def _schedule_compaction(self):
+        if self._compact_timer is None:
+            self._compact_timer = threading.Timer(COMPACT_DELAY, self.compact)
+            self._compact_timer.daemon = True
+            self._compact_timer.start()
+
+    def compact(self):
+        """Append the journaled entries to their CSVs and empty the journal
+
+        The sizes of the CSVs before are noted first, if the appends are cut off the journal
+        still has the entries and _undo_compaction() cuts the files back before they are
+        appended again.
+        """
+        with self._exclusive():
+            if self._compact_timer is not None:
+                self._compact_timer.cancel()
+                self._compact_timer = None
+            pending = {csv_file: rows for csv_file, rows in self._journal_rows.items() if csv_file in self._cache}
+            if pending:
+                sizes = {os.path.basename(csv_file): os.path.getsize(csv_file) for csv_file in pending}
+                marker = os.path.join(self.csv_dir, COMPACTING)
+                with open(marker + '.tmp', 'w', encoding='utf-8') as f:
+                    json.dump(sizes, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(marker + '.tmp', marker)
+                try:
+                    for csv_file, rows in pending.items():
+                        changed = self._stamp(csv_file) != self._cache[csv_file]['stamp']
+                        with REGISTRY.timer('expenses_model_stage_seconds', help=STAGE_HELP, stage='write'):
+                            writer.append_rows(csv_file, rows, list(self.data[csv_file].columns))
+                        if changed:
+                            # Changed on disk meanwhile, the rows are appended to the new content
+                            self._reread(csv_file)
+                        elif csv_file in self._dirty:
+                            # Also changed in memory, save() writes those changes and its sidecar
+                            self._cache[csv_file]['stamp'] = self._stamp(csv_file)
+                            self._changed()
+                        else:
+                            self._written(csv_file)
+                except BaseException:
+                    self._undo_compaction()
+                    raise
+            self._truncate_journal()
+            if os.path.exists(os.path.join(self.csv_dir, COMPACTING)):
+                os.remove(os.path.join(self.csv_dir, COMPACTING))
+
+    def _undo_compaction(self):
+        """Cut off what an interrupted compaction appended to the CSVs, the journal still has those entries"""
+        marker = os.path.join(self.csv_dir, COMPACTING)
+        if not os.path.exists(marker):
+            return
+        if os.path.exists(self.journal_path):
+            with open(marker, encoding='utf-8') as f:
+                sizes = json.load(f)
+            for name, size in sizes.items():
+                csv_file = os.path.join(self.csv_dir, name)
+                if os.path.exists(csv_file) and os.path.getsize(csv_file) > size:
+                    print(f"Removing the entries an interrupted compaction appended to {name}")
+                    os.truncate(csv_file, size)
+        os.remove(marker)
+
+    def _reread(self, csv_file):
+        """Drop a file's data, so its content on disk is read on next use"""
+        self._resident.pop(csv_file, None)
+        self._dirty.discard(csv_file)
+        del self._cache[csv_file]
+        self._stub_or_cached(csv_file, self.store.manifest())
+        self._set_files(sorted(self.csv_files, key=lambda f: self._sort_key(self._cache[f])))
+        self._changed()
+
+    def _truncate_journal(self):
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self._journal_rows = {}
+
+    def _replay_journal(self):
+        """Apply the entries of the journal of an earlier run to the loaded files and compact them"""
+        if not os.path.exists(self.journal_path):
+            return
+        files = {os.path.basename(csv_file): csv_file for csv_file in self.csv_files}
+        with open(self.journal_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A crash while appending leaves at most the last line incomplete
+                    print(f"Skipping incomplete journal line: {line.strip()}")
+                    continue
+                if record['file'] not in files:
+                    print(f"Skipping journal entry of missing file {record['file']}")
+                    continue
+                self._append(files[record['file']], record['row'])
+        self.compact()
 
     
     def df(self, csv_file):
@@ -84,17 +1074,162 @@ class Model:
         return self.data[csv_file]
             
     def expenses(self, csv_file):
-        df = self.data[csv_file]
-        return df[df['Betrag (€)'] < 0]
+        return self.data[csv_file].iloc[self.index[csv_file].expense_rows]
     
     def income(self, csv_file):
-        df = self.data[csv_file]
-        return df[df['Betrag (€)'] > 0]
+        return self.data[csv_file].iloc[self.index[csv_file].income_rows]
     
     def expense_in_category(self, csv_file, category):
-        df = self.data[csv_file]
-        df = df[df['Kategorie'] == category]
-        return df[df['Betrag (€)'] < 0]
+        rows = self.index[csv_file].category_rows.get(category, [])
+        return self.data[csv_file].iloc[rows]
+
+    def category_totals(self, csv_file):
+        """Sum of expenses per category, as positive cents"""
+        return self._summary(csv_file)['category_totals']
+
+    def type_totals(self, csv_file):
+        """Total income and expense, as positive cents"""
+        return self._summary(csv_file)['type_totals']
+
+    def date_span(self, csv_file):
+        """Date span of the expenses of a file, see get_date_span"""
+        min_date, max_date = self._summary(csv_file)['expense_date_range']
+        if pd.notnull(min_date) and pd.notnull(max_date):
+            return f"{min_date.strftime('%d.%m.%Y')} bis {max_date.strftime('%d.%m.%Y')}"
+        return "Zeitraum unbekannt"
+
+    def update_index(self, csv_file, dirty=True, appended=0):
+        """Rebuild the aggregate index of a file after its DataFrame was changed in place
+
+        The file is marked dirty, so the next save() writes it. appended is the number of
+        rows that were only added at the end, the others are not looked up for duplicates again.
+        """
+        entry = self._entry(csv_file)
+        entry.pop('summary', None)
+        if dirty:
+            self._dirty.add(csv_file)
+        entry['dates'] = self._parse_dates(entry['data'])
+        entry['date_range'] = (entry['dates'].min(), entry['dates'].max())
+        entry['index'] = FileIndex(entry['data'], entry['dates'])
+        self._claim(csv_file, entry, changed=True, appended=appended)
+        entry['version'] = next(self._versions)
+        self._ledger = None
+        self._keywords = None
+
+    def duplicates(self, csv_file):
+        """Positions of the rows of a file whose bookings are in another file, left out of totals over all files"""
+        return self._entry(csv_file)['duplicates']
+
+    def version(self, csv_file):
+        """Version of a file's data, changes whenever the file is reloaded, saved or changed in place"""
+        entry = self._cache.get(csv_file)
+        return entry['version'] if entry is not None else 0
+
+    def details_page(self, csv_file, kind='all', category=None, page_current=0, page_size=10,
+                     sort_by=(), filters=()):
+        """Return one page of a details table drill-down and the number of matching rows
+
+        sort_by is a list of (column, ascending) and filters a list of (column, operator, value)
+        with the operators of the Dash DataTable filter syntax. The matching row positions are
+        cached in the file's index, so paging through a result only slices it.
+        """
+        index = self.index[csv_file]
+        key = (kind, category, tuple(sort_by), tuple(filters))
+        positions = index.queries.get(key)
+        if positions is None:
+            positions = self._details_positions(csv_file, kind, category, sort_by, filters)
+            index.remember(key, positions)
+        start = page_current * page_size
+        return self._details_frame(csv_file, kind, positions[start:start + page_size]), len(positions)
+
+    def details_dataset(self, csv_file):
+        """Everything the drill-downs of a file show, as a compact dict for filtering in the browser
+
+        Text and date columns are factorized into their display values and one code per row,
+        -1 where missing, amounts are cents, 'days' the booking dates as days since 1970 for
+        sorting. The rows of each drill-down are the positions in the file's index.
+        """
+        data = self.data[csv_file]
+        index = self.index[csv_file]
+        columns = {}
+        for column in dict.fromkeys(DETAIL_COLUMNS + INCOME_DETAIL_COLUMNS):
+            if column == 'Betrag (€)' or column not in data.columns:
+                continue
+            values = data[column]
+            if pd.api.types.is_datetime64_any_dtype(values):
+                values = schema.format_dates(values)
+            codes, uniques = pd.factorize(values)
+            columns[column] = {'values': np.asarray(uniques, dtype=object).tolist(), 'codes': codes.tolist()}
+        dates = self.dates[csv_file]
+        days = (dates.asi8 // (24 * 3600 * 10 ** 9)).astype(object)
+        days[dates.isna()] = None
+        return {
+            'csv': csv_file,
+            'detail_columns': DETAIL_COLUMNS,
+            'income_columns': INCOME_DETAIL_COLUMNS,
+            'columns': columns,
+            'amounts': data['Betrag (€)'].tolist(),
+            'days': days.tolist(),
+            'expenses': index.expense_rows.tolist(),
+            'income': index.income_rows.tolist(),
+            'categories': {category: rows.tolist() for category, rows in index.category_rows.items()},
+        }
+
+    def _details_frame(self, csv_file, kind, positions):
+        columns = INCOME_DETAIL_COLUMNS if kind == 'income' else DETAIL_COLUMNS
+        data = self.data[csv_file]
+        df = data.iloc[positions, [data.columns.get_loc(column) for column in columns]]
+        if kind == 'all':
+            # The overview table lists all amounts as absolute values
+            df = df.assign(**{'Betrag (€)': df['Betrag (€)'].abs()})
+        return df
+
+    def _details_positions(self, csv_file, kind, category, sort_by, filters):
+        positions = self.index[csv_file].rows(kind, category)
+        df = self._details_frame(csv_file, kind, positions)
+        mask = np.ones(len(df), dtype=bool)
+        for column, operator, value in filters:
+            if column in df.columns:
+                mask &= self._filter_mask(df[column], operator, value)
+        df = df[mask]
+        positions = positions[mask]
+        if not sort_by and kind != 'all':
+            # Drill-downs are sorted by amount unless the user sorts by another column
+            sort_by = [('Betrag (€)', True)]
+        for column, ascending in sort_by[:1]:
+            if column not in df.columns:
+                continue
+            keys = df[column].reset_index(drop=True)
+            order = keys.sort_values(ascending=ascending, kind='stable').index
+            positions = positions[order.to_numpy()]
+        return positions
+
+    def _filter_mask(self, values, operator, value):
+        """Boolean mask of a Dash DataTable filter expression on one column"""
+        # Filter on what the table shows: euros and dd.mm.yy dates
+        if values.name == 'Betrag (€)' and pd.api.types.is_integer_dtype(values):
+            values = schema.to_euros(values)
+        elif pd.api.types.is_datetime64_any_dtype(values):
+            values = values.dt.strftime(schema.DATE_FORMAT)
+        if operator == 'contains':
+            return values.astype(str).str.contains(str(value), case=False, regex=False).to_numpy()
+        if operator == 'datestartswith':
+            return values.astype(str).str.startswith(str(value)).to_numpy()
+        if pd.api.types.is_numeric_dtype(values):
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                return np.zeros(len(values), dtype=bool)
+        else:
+            values = values.astype(str)
+            value = str(value)
+        compare = {
+            'eq': values.__eq__, 'ne': values.__ne__, 'lt': values.__lt__,
+            'le': values.__le__, 'gt': values.__gt__, 'ge': values.__ge__,
+        }.get(operator)
+        if compare is None:
+            return np.ones(len(values), dtype=bool)
+        return compare(value).to_numpy()
 
     def get_date_span(self, df):
         if df.empty:
@@ -106,68 +1241,63 @@ class Model:
             return f"{min_date.strftime('%d.%m.%Y')} bis {max_date.strftime('%d.%m.%Y')}"
         return "Zeitraum unbekannt"
     
-    def _convert_betrag_column(self, df):
-        """Convert 'Betrag (€)' column from German to standard decimal notation."""
+    @staticmethod
+    def _convert_betrag_column(df):
+        """Convert the 'Betrag (€)' column to int64 cents.
+
+        The reader already parses the amounts to cents, this only handles frames with
+        euro amounts or amounts it had to leave as German notation text.
+        """
         if 'Betrag (€)' in df.columns:
-            # Convert to string and handle NaN values
-            df['Betrag (€)'] = df['Betrag (€)'].astype(str).replace('nan', '0')
-            
-            # German format: 1.234,56 -> Standard format: 1234.56
-            # First remove dots (thousand separators), then replace comma with dot (decimal)
-            df['Betrag (€)'] = (
-                df['Betrag (€)']
-                .str.replace('.', '', regex=False)   # Remove thousand separator (dots)
-                .str.replace(',', '.', regex=False)  # Replace decimal comma with dot
-            )
-            # Convert to numeric
-            df['Betrag (€)'] = pd.to_numeric(df['Betrag (€)'], errors='coerce')
+            amounts = df['Betrag (€)']
+            if pd.api.types.is_integer_dtype(amounts):
+                return df
+            if pd.api.types.is_numeric_dtype(amounts):
+                df['Betrag (€)'] = schema.to_cents(amounts)
+            else:
+                df['Betrag (€)'] = schema.parse_cents(amounts)
         return df
 
-    def _load_data(self, csv_file):
-        """Load CSV data with robust error handling for different formats"""
-        df = None
-        
-        # Try different approaches to read the CSV file
-        # Start with skiprows=4 since that's the most common format for bank exports
-        for skip_rows in [4, 0, 1, 2, 3, 5]:
-            try:
-                df = pd.read_csv(
-                    csv_file, 
-                    delimiter=';', 
-                    encoding='utf-8', 
-                    skiprows=skip_rows,
-                    on_bad_lines='skip',  # Skip problematic lines
-                    quotechar='"'  # Handle quoted fields properly
-                )
-                # Check if we have the required columns
-                if all(col in df.columns for col in ['Buchungsdatum', 'Betrag (€)']):
-                    # Remove any completely empty rows
-                    df = df.dropna(how='all')
-                    break
-                else:
-                    df = None
-            except Exception:
-                continue
-        
-        # If still no success, try with the old method as fallback
-        if df is None:
-            try:
-                df = pd.read_csv(csv_file, delimiter=';', encoding='utf-8', quotechar='"')
-            except Exception:
-                df = pd.read_csv(csv_file, delimiter=';', encoding='utf-8', skiprows=4, quotechar='"')
-        
-        df = self._convert_betrag_column(df)
-        df = self._preprocess_income(df)
+    @staticmethod
+    def _load_data(csv_file):
+        """Load CSV data, the header row, delimiter and encoding are sniffed so the file is parsed once"""
+        with REGISTRY.timer('expenses_model_stage_seconds', help=STAGE_HELP, stage='parse'):
+            df = reader.read_csv(csv_file)
+        with REGISTRY.timer('expenses_model_stage_seconds', help=STAGE_HELP, stage='preprocess'):
+            df = Model._convert_betrag_column(df)
+            df = Model._preprocess_income(df)
+            df = schema.compact(df)
         return df
+
+    @staticmethod
+    def read_file(csv_file, store=None):
+        """The frame of one CSV as the dashboard sees it, without building a model of its directory
+
+        Read from the sidecar in store if it is up to date, parsed otherwise. For other
+        programs working on the same files, e.g. expenses/report.py.
+        """
+        if store is not None:
+            stored = store.load(csv_file, Model._stamp(csv_file))
+            if stored is not None:
+                return stored[0]
+        return Model._load_data(csv_file)
     
-    def _preprocess_income(self, df):
+    @staticmethod
+    def _merged(df):
+        """Mask of the 'Ausgleich' rows _preprocess_income merges into one"""
+        if "Verwendungszweck" not in df.columns:
+            return np.zeros(len(df), dtype=bool)
+        # Handle potential missing values in the column
+        return df["Verwendungszweck"].astype(object).fillna("").str.contains("Ausgleich", case=True, na=False).to_numpy()
+
+    @staticmethod
+    def _preprocess_income(df):
         """Preprocess income data."""
         # Check if the required column exists
         if "Verwendungszweck" not in df.columns:
             return df
             
-        # Handle potential missing values in the column
-        mask = df["Verwendungszweck"].fillna("").str.contains("Ausgleich", case=True, na=False)
+        mask = Model._merged(df)
 
         matching_rows = df[mask]
         if matching_rows.empty:
@@ -176,31 +1306,29 @@ class Model:
         try:
             total_sum = matching_rows["Betrag (€)"].sum()
             
-            # Get the first row's values safely
-            first_row = matching_rows.iloc[0]
+            # Get the first row's values safely, column by column so categoricals are not unboxed
+            first_row = {column: matching_rows[column].iloc[0] for column in matching_rows.columns}
             
             summary_row = { 
-                "Buchungsdatum": [first_row.get("Buchungsdatum", "")],
-                "Wertstellung": [first_row.get("Wertstellung", "")],
-                "Status": [first_row.get("Status", "")],
-                "Zahlungspflichtige*r": [""],
-                "Zahlungsempfänger*in": [""],
-                "Verwendungszweck": ["Ausgleich Verrechnet"],
-                "Umsatztyp": ["Zusammenfassung"],
-                "IBAN": [""],
-                "Betrag (€)": [total_sum],
-                "Gläubiger-ID": [""],
-                "Mandatsreferenz": [""],
-                "Kundenreferenz": [""],
-                "Kategorie": ["sonstiges"]
+                "Buchungsdatum": first_row.get("Buchungsdatum", ""),
+                "Wertstellung": first_row.get("Wertstellung", ""),
+                "Status": first_row.get("Status", ""),
+                "Zahlungspflichtige*r": "",
+                "Zahlungsempfänger*in": "",
+                "Verwendungszweck": "Ausgleich Verrechnet",
+                "Umsatztyp": "Zusammenfassung",
+                "IBAN": "",
+                "Betrag (€)": total_sum,
+                "Gläubiger-ID": "",
+                "Mandatsreferenz": "",
+                "Kundenreferenz": "",
+                "Kategorie": "sonstiges"
             }
             
             # Only include columns that exist in the original dataframe
             summary_row = {k: v for k, v in summary_row.items() if k in df.columns}
             
-            summary_row_df = pd.DataFrame(summary_row)
-            df = df[~mask]
-            df = pd.concat([df, summary_row_df], ignore_index=True)
+            df = schema.append_row(df[~mask], summary_row)
         except Exception as e:
             print(f"Error in _preprocess_income: {e}")
             # If there's an error, just return the original dataframe
@@ -0,0 +1,183 @@
+"""Single-pass reader for semicolon separated bank exports."""
+import codecs
+import csv
+import functools
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
+
+from .schema import AMOUNT_COLUMN, CATEGORICAL_COLUMNS, CENTS, DATE_COLUMNS, DATE_FORMAT, to_cents
+
+
+REQUIRED_COLUMNS = ['Buchungsdatum', AMOUNT_COLUMN]
+SAMPLE_SIZE = 16 * 1024
+ENCODINGS = ['utf-8-sig', 'cp1252', 'latin-1']
+DELIMITERS = [';', ',', '\t']
+
+CsvFormat = namedtuple('CsvFormat', ['skiprows', 'delimiter', 'encoding', 'columns'])
+
+
+def _is_path(source):
+    return isinstance(source, str) or hasattr(source, '__fspath__')
+
+
+def _read_sample(source):
+    """Read the first bytes of a path or binary buffer without consuming the buffer"""
+    if _is_path(source):
+        with open(source, 'rb') as f:
+            return f.read(SAMPLE_SIZE)
+    position = source.tell()
+    sample = source.read(SAMPLE_SIZE)
+    source.seek(position)
+    return sample
+
+
+def _decode_sample(sample):
+    """Decode a sample with the first encoding that fits, ignoring a cut-off trailing character"""
+    for encoding in ENCODINGS:
+        try:
+            return codecs.getincrementaldecoder(encoding)().decode(sample, final=False), encoding
+        except UnicodeDecodeError:
+            continue
+    return sample.decode('latin-1'), 'latin-1'
+
+
+def sniff(source):
+    """Find header row, delimiter and encoding by looking at the first few KB of a CSV export"""
+    return _sniff_text(*_decode_sample(_read_sample(source)))
+
+
+def _sniff_text(text, encoding):
+    lines = text.split('\n')
+    for skiprows, line in enumerate(lines):
+        if all(column in line for column in REQUIRED_COLUMNS):
+            delimiter = max(DELIMITERS, key=line.count)
+            columns = next(csv.reader([line.rstrip('\r')], delimiter=delimiter, quotechar='"'))
+            return CsvFormat(skiprows, delimiter, encoding, columns)
+    return CsvFormat(0, ';', encoding, None)
+
+
+def first_date(source):
+    """Earliest booking date of the rows in the first few KB of a CSV export, NaT if there are none
+
+    Orders files before they are parsed, from the same sample sniff() looks at.
+    """
+    text, encoding = _decode_sample(_read_sample(source))
+    fmt = _sniff_text(text, encoding)
+    if fmt.columns is None or 'Buchungsdatum' not in fmt.columns:
+        return pd.NaT
+    position = fmt.columns.index('Buchungsdatum')
+    # The last line may be cut off by the end of the sample
+    lines = [line.rstrip('\r') for line in text.split('\n')[fmt.skiprows + 1:-1]]
+    dates = [row[position] for row in csv.reader(lines, delimiter=fmt.delimiter, quotechar='"')
+             if len(row) == len(fmt.columns)]
+    return pd.to_datetime(pd.Series(dates, dtype=object), format=DATE_FORMAT, errors='coerce').min()
+
+
+def _read_pyarrow(source, fmt):
+    """Parse with the pyarrow CSV engine and convert amounts, dates and categoricals in arrow"""
+    if _is_path(source):
+        with open(source, 'rb') as f:
+            return _read_pyarrow(f, fmt)
+    table = pa_csv.read_csv(
+        source,
+        read_options=pa_csv.ReadOptions(
+            skip_rows=fmt.skiprows,
+            encoding='utf8' if fmt.encoding == 'utf-8-sig' else fmt.encoding,
+        ),
+        parse_options=pa_csv.ParseOptions(
+            delimiter=fmt.delimiter,
+            quote_char='"',
+            invalid_row_handler=lambda row: 'skip',
+        ),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={column: pa.string() for column in fmt.columns},
+            strings_can_be_null=True,
+        ),
+    )
+    # Remove any completely empty rows before they are converted to Python objects
+    empty = functools.reduce(pc.and_, [pc.is_null(column) for column in table.columns])
+    table = table.filter(pc.invert(empty))
+    if AMOUNT_COLUMN in table.column_names:
+        index = table.column_names.index(AMOUNT_COLUMN)
+        amounts = pc.replace_substring(table.column(index), '.', '')
+        amounts = pc.replace_substring(amounts, ',', '.')
+        try:
+            # Rounding makes the cents exact, the float only holds the parsed decimal
+            cents = pc.round(pc.multiply(pc.cast(amounts, pa.float64()), float(CENTS)))
+            table = table.set_column(index, AMOUNT_COLUMN, pc.fill_null(pc.cast(cents, pa.int64()), 0))
+        except pa.ArrowInvalid:
+            # Leave unparseable amounts to the pandas fallback
+            pass
+    for index, column in enumerate(table.column_names):
+        if column in DATE_COLUMNS:
+            dates = pc.strptime(table.column(index), format=DATE_FORMAT, unit='ns', error_is_null=True)
+            table = table.set_column(index, column, dates)
+        elif column in CATEGORICAL_COLUMNS:
+            table = table.set_column(index, column, _sorted_dictionary(table.column(index)))
+    return table_to_frame(table)
+
+
+def _sorted_dictionary(values):
+    """Dictionary encode a string column with sorted values, so pandas gets sorted categories"""
+    categories = pc.drop_null(pc.unique(values))
+    categories = categories.take(pc.array_sort_indices(categories))
+    indices = pc.index_in(values, value_set=categories)
+    return pa.chunked_array([pa.DictionaryArray.from_arrays(indices.combine_chunks(), categories)])
+
+
+def table_to_frame(table, zero_copy=False):
+    """Convert an arrow table to a DataFrame, with NaN rather than None for missing text like the C engine
+
+    zero_copy keeps every column in its own block, which lets columns without missing values
+    share the arrow buffers instead of being copied. Those columns are read-only.
+    """
+    df = table.to_pandas(split_blocks=zero_copy)
+    for column, values in zip(table.column_names, table.columns):
+        if not values.null_count or not (pa.types.is_string(values.type) or pa.types.is_null(values.type)):
+            continue
+        if values.null_count == len(df):
+            df[column] = pd.Series(np.nan, index=df.index, dtype=object)
+        else:
+            df[column] = df[column].fillna(np.nan)
+    return df
+
+
+def read_csv(source, fmt=None):
+    """Read a bank export with exactly one parse
+
+    The amount column is converted from German notation (1.234,56) to int64 cents during
+    the parse, missing amounts count as 0. With pyarrow the dates and categorical columns
+    of the compact schema are converted as well, everything else is read as text.
+    """
+    if fmt is None:
+        fmt = sniff(source)
+    if fmt.columns is None:
+        # No known header in the sample, parse the file as it is
+        return pd.read_csv(source, delimiter=fmt.delimiter, encoding=fmt.encoding, quotechar='"')
+    if pa is not None and len(set(fmt.columns)) == len(fmt.columns):
+        return _read_pyarrow(source, fmt)
+    df = pd.read_csv(
+        source,
+        delimiter=fmt.delimiter,
+        encoding=fmt.encoding,
+        skiprows=fmt.skiprows,
+        on_bad_lines='skip',  # Skip problematic lines
+        quotechar='"',  # Handle quoted fields properly
+        dtype={column: str for column in fmt.columns if column != AMOUNT_COLUMN},
+        decimal=',',
+        thousands='.',
+    )
+    # Remove any completely empty rows
+    df = df.dropna(how='all')
+    if pd.api.types.is_float_dtype(df[AMOUNT_COLUMN]):
+        df[AMOUNT_COLUMN] = to_cents(df[AMOUNT_COLUMN])
+    return df
@@ -0,0 +1,179 @@
+"""Compact in-memory schema of the parsed bank exports.
+
+Amounts are int64 cents, so sums are exact, low-cardinality text columns are
+categoricals and the booking dates are datetime64. Display strings are only
+produced at the edges: by the View for the browser and when writing CSVs.
+"""
+import numpy as np
+import pandas as pd
+
+
+AMOUNT_COLUMN = 'Betrag (€)'
+CATEGORICAL_COLUMNS = ['Kategorie', 'Umsatztyp', 'Status', 'Zahlungsempfänger*in', 'Zahlungspflichtige*r', 'IBAN']
+DATE_COLUMNS = ['Buchungsdatum', 'Wertstellung']
+DATE_FORMAT = '%d.%m.%y'
+CENTS = 100
+
+
+def to_cents(euros):
+    """Float euro amounts as int64 cents, missing amounts count as 0"""
+    euros = np.asarray(euros, dtype=float)
+    return np.rint(np.nan_to_num(euros, nan=0.0) * CENTS).astype(np.int64)
+
+
+def parse_cents(text):
+    """German notation amounts (-1.234,56) as int64 cents, unparseable amounts count as 0"""
+    text = pd.Series(text, dtype=object).astype(str)
+    euros = pd.to_numeric(text.str.replace('.', '', regex=False).str.replace(',', '.', regex=False),
+                          errors='coerce')
+    return to_cents(euros)
+
+
+def to_euros(cents):
+    return cents / CENTS
+
+
+def format_cents(cents):
+    """int64 cents as German notation strings without thousands separator, e.g. -1234,56"""
+    return np.array([
+        f"{'-' if value < 0 else ''}{abs(value) // CENTS},{abs(value) % CENTS:02d}"
+        for value in np.asarray(cents, dtype=np.int64).tolist()
+    ], dtype=object)
+
+
+def format_dates(dates):
+    """datetime64 values as dd.mm.yy strings, NaN where missing
+
+    Bookings share few distinct days, so each day is formatted once.
+    """
+    codes, days = pd.factorize(dates)
+    text = np.append(np.asarray(days.strftime(DATE_FORMAT), dtype=object), np.nan)
+    return text[codes]
+
+
+def compact(df):
+    """Convert the text and date columns of a parsed export to the compact schema, in place"""
+    for column in DATE_COLUMNS:
+        if column in df.columns and not pd.api.types.is_datetime64_any_dtype(df[column]):
+            df[column] = pd.to_datetime(df[column], format=DATE_FORMAT, errors='coerce')
+    return categorize(df)
+
+
+def categorize(df, columns=CATEGORICAL_COLUMNS):
+    """Store the given text columns as categoricals with sorted categories, in place"""
+    for column in columns:
+        if column not in df.columns:
+            continue
+        if not isinstance(df[column].dtype, pd.CategoricalDtype):
+            # Through object so that an all-missing column still gets text categories
+            df[column] = df[column].astype(object).astype('category')
+        elif not df[column].cat.categories.is_monotonic_increasing:
+            # Categories come in order of appearance from the reader, keep them sorted
+            df[column] = df[column].cat.reorder_categories(sorted(df[column].cat.categories))
+    return df
+
+
+def concat(frames):
+    """pd.concat that keeps columns categorical in every frame categorical
+
+    pd.concat turns categoricals whose categories differ into text. Here all categories are
+    factorized once and each frame's codes remapped, so the union keeps the order of appearance.
+    """
+    categorical = [
+        column for column in frames[0].columns
+        if all(column in df.columns and isinstance(df[column].dtype, pd.CategoricalDtype) for df in frames)
+    ]
+    df = pd.concat([frame.drop(columns=categorical) for frame in frames])
+    for column in categorical:
+        parts = [frame[column].array for frame in frames]
+        mapping, categories = pd.factorize(np.concatenate([part.categories.to_numpy() for part in parts]))
+        offsets = np.cumsum([0] + [len(part.categories) for part in parts[:-1]])
+        codes = np.concatenate([
+            np.where(part.codes >= 0, mapping[offset + part.codes.astype(np.intp)], -1)
+            for part, offset in zip(parts, offsets)
+        ])
+        df[column] = pd.Categorical.from_codes(codes, categories)
+    # Back to the column order pd.concat would give
+    return df[list(dict.fromkeys(column for frame in frames for column in frame.columns))]
+
+
+def append_row(df, row):
+    """Return df with one row appended, row maps columns to values and missing columns are left empty
+
+    Appends column by column, so categoricals and dates keep their dtype and all-missing text
+    columns are not scanned value by value like pd.concat does.
+    """
+    columns = {}
+    for column in df.columns:
+        values = df[column]
+        value = row.get(column, np.nan)
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            categories = values.cat.categories
+            codes = values.cat.codes.to_numpy()
+            if pd.isnull(value):
+                code = -1
+            elif value in categories:
+                code = categories.get_loc(value)
+            else:
+                # Insert the new category at its sorted position and shift the codes behind it
+                code = categories.searchsorted(value)
+                categories = categories.insert(code, value)
+                codes = np.where(codes >= code, codes + 1, codes)
+            columns[column] = pd.Categorical.from_codes(np.append(codes, code), categories)
+        elif pd.api.types.is_datetime64_any_dtype(values):
+            columns[column] = np.append(values.to_numpy(), pd.Timestamp(value).to_datetime64())
+        else:
+            columns[column] = np.append(values.to_numpy(), [value])
+    return pd.DataFrame(columns)
+
+
+def assign(df, column, positions, values):
+    """Set df[column] at the row positions to values, in place
+
+    New values of a categorical column are added to its categories at their sorted position.
+    """
+    values = np.asarray(values, dtype=object)
+    if isinstance(df[column].dtype, pd.CategoricalDtype):
+        current = df[column].cat
+        categories = current.categories.union(pd.Index(pd.unique(values)))
+        codes = current.set_categories(categories).cat.codes.to_numpy().copy()
+        codes[positions] = categories.get_indexer(values)
+        df[column] = pd.Categorical.from_codes(codes, categories)
+    else:
+        # A copy, the column may be a read-only view of a memory-mapped sidecar
+        updated = df[column].copy()
+        # Amounts and dates keep their dtype, the values are boxed above for the categoricals
+        updated.iloc[positions] = values if updated.dtype == object else values.astype(updated.dtype)
+        df[column] = updated
+    return df
+
+
+def to_display(df):
+    """Copy of a compact frame with euro amounts, dd.mm.yy dates and plain text for the browser"""
+    return pd.DataFrame(_decompact(df, to_euros), index=df.index)
+
+
+def to_records(df):
+    """Rows of a compact frame as display records for a DataTable, like to_display(df).to_dict('records')"""
+    columns = _decompact(df, to_euros)
+    return [dict(zip(columns, row)) for row in zip(*(values.tolist() for values in columns.values()))]
+
+
+def to_export(df):
+    """Copy of a frame as the text a bank export would contain, for writing CSVs"""
+    return pd.DataFrame(_decompact(df, format_cents), index=df.index)
+
+
+def _decompact(df, amounts):
+    """Columns of df as Series of display values, amounts converts the cents"""
+    columns = {}
+    for column in df.columns:
+        values = df[column]
+        if column == AMOUNT_COLUMN and pd.api.types.is_integer_dtype(values):
+            values = pd.Series(amounts(values.to_numpy()), index=df.index)
+        elif pd.api.types.is_datetime64_any_dtype(values):
+            values = pd.Series(format_dates(values), index=df.index)
+        elif isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.astype(object)
+        columns[column] = values
+    return columns
@@ -0,0 +1,80 @@
+"""Coordination of several server processes on one csv directory.
+
+Every worker keeps its own Model, what they share are the files on disk: the CSVs,
+their memory-mapped sidecars and a version counter next to the sidecars. Every
+write bumps the counter, workers compare it before handling a request and only
+reload the files whose stamp changed, from the sidecar the writer left behind.
+"""
+import contextlib
+import os
+
+try:
+    import fcntl
+except ImportError:
+    # No locks between processes, e.g. on Windows where gunicorn does not run anyway
+    fcntl = None
+
+
+VERSION_FILE = 'version'
+
+
+class SharedVersion:
+    def __init__(self, cache_dir, lock):
+        """lock is the threading.RLock of the model, held together with the file lock"""
+        self.path = os.path.join(cache_dir, VERSION_FILE)
+        self._thread_lock = lock
+        self._file = None
+        self._depth = 0
+
+    def current(self):
+        """The version of the directory, 0 before the first write"""
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return int(f.read() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    @contextlib.contextmanager
+    def lock(self):
+        """Exclusive access to the directory across processes and threads, reentrant"""
+        with self._thread_lock:
+            if self._depth == 0:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self._file = open(self.path + '.lock', 'a')
+                if fcntl is not None:
+                    fcntl.flock(self._file, fcntl.LOCK_EX)
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+                if self._depth == 0:
+                    # Closing the file releases the flock
+                    self._file.close()
+                    self._file = None
+
+    def try_lock(self, name):
+        """Lock the file name.lock next to the version without waiting, None if another process holds it
+
+        The lock is held until the returned file is closed, e.g. by the one process doing a job
+        all of them would otherwise do.
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        f = open(os.path.join(os.path.dirname(self.path), name + '.lock'), 'a')
+        if fcntl is not None:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                return None
+        return f
+
+    def bump(self):
+        """Count a write to the directory, returns the new version"""
+        with self.lock():
+            version = self.current() + 1
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.write(str(version))
+            os.replace(tmp, self.path)
+            return version
@@ -0,0 +1,170 @@
+"""Columnar sidecar files of parsed bank exports.
+
+The CSV exports stay the source of truth. Next to them the store keeps one
+Feather (Arrow IPC) file per export with the normalized frame, stamped with
+the mtime, size and hash of the CSV it was built from. A small JSON manifest
+repeats the stamp and booking date range of every sidecar, so the files can be
+listed and ordered without opening any of them.
+"""
+import contextlib
+import glob
+import hashlib
+import json
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Only locked between threads, e.g. on Windows where gunicorn does not run anyway
+    fcntl = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:
+    pa = None
+
+from .reader import table_to_frame
+
+
+METADATA_KEY = b'expenses.source'
+MANIFEST = 'manifest.json'
+# Held while sidecars and the manifest are written, by the processes sharing the directory
+LOCK = 'manifest.lock'
+# Bumped when the layout of the stored frames changes, older sidecars are rebuilt
+SCHEMA_VERSION = 2
+
+
+def file_hash(path):
+    """SHA-1 of a file's content"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class SidecarStore:
+    def __init__(self, csv_dir, cache_dir=None):
+        self.cache_dir = cache_dir or os.path.join(csv_dir, '.cache')
+        # {csv basename: {'stamp': [...], 'date_range': [...]}}, read on first use
+        self._manifest = None
+        self._thread_lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return pa is not None
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Exclusive access to the sidecars and the manifest across threads and processes, not reentrant"""
+        with self._thread_lock:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Closing the file releases the flock
+            with open(os.path.join(self.cache_dir, LOCK), 'a') as f:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                yield
+
+    def path(self, csv_file):
+        return os.path.join(self.cache_dir, os.path.basename(csv_file) + '.feather')
+
+    def manifest(self, reload=False):
+        """{csv basename: {'stamp': [mtime_ns, size], 'date_range': [first, last]}} of the current sidecars
+
+        reload reads the file again, other processes may have changed it.
+        """
+        if self._manifest is None or reload:
+            self._manifest = {}
+            if self.enabled:
+                try:
+                    with open(os.path.join(self.cache_dir, MANIFEST), encoding='utf-8') as f:
+                        manifest = json.load(f)
+                    if manifest.get('schema') == SCHEMA_VERSION:
+                        self._manifest = manifest['files']
+                except (OSError, ValueError, KeyError):
+                    pass
+        return self._manifest
+
+    def _set_manifest(self, csv_file, metadata):
+        # Read again right before the write, under _locked() so no entries of other processes are lost
+        files = self.manifest(reload=True)
+        if metadata is None:
+            if files.pop(os.path.basename(csv_file), None) is None:
+                return
+        else:
+            files[os.path.basename(csv_file)] = {'stamp': metadata['stamp'], 'date_range': metadata.get('date_range')}
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = os.path.join(self.cache_dir, MANIFEST)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'schema': SCHEMA_VERSION, 'files': files}, f)
+        os.replace(tmp, path)
+
+    def load(self, csv_file, stamp, zero_copy=False):
+        """Return (DataFrame, metadata) from the sidecar of csv_file, None if missing or stale
+
+        With zero_copy the numeric, date and categorical columns are read-only views of the
+        memory-mapped file, so processes reading the same sidecar share its pages.
+        """
+        if not self.enabled or not os.path.exists(self.path(csv_file)):
+            return None
+        try:
+            table = feather.read_table(self.path(csv_file), memory_map=True)
+            metadata = json.loads(table.schema.metadata[METADATA_KEY])
+        except Exception as e:
+            print(f"Ignoring unreadable sidecar for {csv_file}: {e}")
+            return None
+        if metadata.get('schema') != SCHEMA_VERSION:
+            return None
+        if tuple(metadata['stamp']) != tuple(stamp):
+            # Touched but not changed, e.g. copied again by a sync job
+            if metadata.get('hash') != file_hash(csv_file):
+                return None
+            metadata['stamp'] = list(stamp)
+            with self._locked():
+                self._write(csv_file, table.replace_schema_metadata({METADATA_KEY: json.dumps(metadata)}))
+                self._set_manifest(csv_file, metadata)
+        return table_to_frame(table.replace_schema_metadata(None), zero_copy), metadata
+
+    def save(self, csv_file, stamp, df, **metadata):
+        """Write the normalized frame of csv_file, extra metadata must be JSON serializable"""
+        if not self.enabled:
+            return
+        metadata.update(stamp=list(stamp), hash=file_hash(csv_file), schema=SCHEMA_VERSION)
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+            print(f"Not caching {csv_file}: {e}")
+            return
+        with self._locked():
+            self._write(csv_file, table.replace_schema_metadata({METADATA_KEY: json.dumps(metadata)}))
+            self._set_manifest(csv_file, metadata)
+
+    def _write(self, csv_file, table):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.path(csv_file)
+        # Per process and thread, several may write the same sidecar at once
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        # Uncompressed so that reads can memory-map the file
+        feather.write_feather(table, tmp, compression='uncompressed')
+        os.replace(tmp, path)
+
+    def remove(self, csv_file):
+        with self._locked():
+            if os.path.exists(self.path(csv_file)):
+                os.remove(self.path(csv_file))
+            if self.enabled:
+                self._set_manifest(csv_file, None)
+
+    def clear(self):
+        """Drop all sidecars and the manifest, they are rebuilt from the CSVs on the next load
+
+        Everything else in the cache directory is left alone, other stores keep their files there.
+        """
+        with self._locked():
+            for path in glob.glob(os.path.join(self.cache_dir, '*.feather')) + [os.path.join(self.cache_dir, MANIFEST)]:
+                if os.path.exists(path):
+                    os.remove(path)
+            self._manifest = {}
@@ -0,0 +1,219 @@
+"""Queue of uploaded bank exports, classified and saved in a background thread.
+
+The upload callback only queues the files and returns. A page polls the jobs
+for their progress, rows parsed and classified so far, and can cancel them;
+a cancelled job stops before its file is written.
+
+With several server processes on one directory, see shared.py, the poll or the
+cancel of a job may reach another process than the one running it. The state of
+every job is kept in a small JSON file in the shared .cache then, and a cancel
+is a file the running process looks for before each step.
+"""
+import itertools
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from ..metrics import REGISTRY
+
+
+# Finished jobs kept for pages to show their outcome
+KEEP_FINISHED = 20
+# Next to the sidecars in a shared directory, one <job id>.json per job
+JOBS_DIR = 'uploads'
+# Seconds the jobs of a process that stopped are shown, their files are removed after
+STALE_AFTER = 3600
+FIELDS = ['id', 'filename', 'state', 'rows', 'classified', 'output', 'duplicates', 'error', 'pid', 'submitted']
+
+
+class Cancelled(Exception):
+    pass
+
+
+class UploadJob:
+    def __init__(self, job_id, filename, content):
+        self.id = job_id
+        self.filename = filename
+        self.content = content
+        # queued, parsing, classifying, writing, then done, failed or cancelled
+        self.state = 'queued'
+        self.rows = None
+        self.classified = 0
+        self.output = None
+        # Rows of the saved file that were in other files already
+        self.duplicates = 0
+        self.error = None
+        self.cancel_requested = False
+        self.pid = os.getpid()
+        self.submitted = time.time()
+        # Shared jobs write their state on every change, see UploadQueue
+        self.path = None
+
+    @property
+    def finished(self):
+        return self.state in ('done', 'failed', 'cancelled')
+
+    @property
+    def cancelled(self):
+        return self.cancel_requested or (self.path is not None and os.path.exists(self.path + '.cancel'))
+
+    def progress(self, stage, done, total):
+        """Progress callback of Model.classify_and_save_upload, raises Cancelled once cancel() was called"""
+        if self.cancelled:
+            raise Cancelled()
+        self.state = stage
+        if stage == 'classifying':
+            self.rows = total
+            self.classified = done
+        self.store()
+
+    def store(self):
+        if self.path is None:
+            return
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({field: getattr(self, field) for field in FIELDS}, f)
+        os.replace(tmp, self.path)
+
+    @classmethod
+    def load(cls, path):
+        """A job of another process from its state file, None if it is gone or being replaced"""
+        try:
+            with open(path, encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        job = cls(state['id'], state['filename'], None)
+        for field in FIELDS:
+            setattr(job, field, state.get(field))
+        job.path = path
+        return job
+
+
+class UploadQueue:
+    def __init__(self, model, workers=1):
+        """workers are the uploads processed at once, one keeps writes and the classification cache serialized
+
+        The jobs of a model with a shared directory are seen by all processes serving it.
+        """
+        self.model = model
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='expenses-upload')
+        self._jobs = OrderedDict()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.jobs_dir = os.path.join(model.store.cache_dir, JOBS_DIR) if model.shared is not None else None
+
+    def submit(self, content, filename=None):
+        """Queue the raw bytes of an export, returns the job"""
+        with self._lock:
+            if self.jobs_dir is None:
+                job = UploadJob(str(next(self._ids)), filename, content)
+            else:
+                # Unique across the processes
+                job = UploadJob(uuid.uuid4().hex[:12], filename, content)
+                os.makedirs(self.jobs_dir, exist_ok=True)
+                job.path = os.path.join(self.jobs_dir, job.id + '.json')
+                job.store()
+            self._jobs[job.id] = job
+            finished = [job_id for job_id, other in self._jobs.items() if other.finished]
+            for job_id in finished[:max(0, len(finished) - KEEP_FINISHED)]:
+                self._drop(self._jobs.pop(job_id))
+        self._executor.submit(self._run, job)
+        return job
+
+    def cancel(self, job_id):
+        """Stop a job before its file is written, returns whether it was still running"""
+        job = self._jobs.get(job_id)
+        if job is None and self.jobs_dir is not None:
+            # Run by another process, which looks for the cancel file
+            job = UploadJob.load(os.path.join(self.jobs_dir, os.path.basename(job_id) + '.json'))
+            if job is None or job.finished:
+                return False
+            open(job.path + '.cancel', 'w').close()
+            return True
+        if job is None or job.finished:
+            return False
+        job.cancel_requested = True
+        if job.state == 'queued':
+            job.state = 'cancelled'
+            job.content = None
+            job.store()
+        return True
+
+    def jobs(self):
+        """All running and recently finished jobs, oldest first"""
+        with self._lock:
+            jobs = list(self._jobs.values())
+        if self.jobs_dir is None:
+            return jobs
+        others = []
+        for name in os.listdir(self.jobs_dir) if os.path.isdir(self.jobs_dir) else []:
+            job_id, extension = os.path.splitext(name)
+            if extension != '.json' or job_id in self._jobs:
+                continue
+            job = UploadJob.load(os.path.join(self.jobs_dir, name))
+            if job is None:
+                continue
+            if not _alive(job.pid):
+                if time.time() - job.submitted > STALE_AFTER:
+                    self._drop(job)
+                    continue
+                if not job.finished:
+                    job.state, job.error = 'failed', 'the server process handling it stopped'
+            others.append(job)
+        return sorted(jobs + others, key=lambda job: job.submitted)
+
+    def _drop(self, job):
+        """Remove the files of a finished job that is not shown any more"""
+        if job.path is not None:
+            for path in (job.path, job.path + '.cancel'):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    # Removed by another process meanwhile
+                    pass
+
+    @property
+    def active(self):
+        return any(not job.finished for job in self.jobs())
+
+    def _run(self, job):
+        if job.cancelled:
+            if not job.finished:
+                job.state = 'cancelled'
+                job.content = None
+                job.store()
+            return
+        start = time.perf_counter()
+        try:
+            job.progress('parsing', 0, 0)
+            job.output = self.model.classify_and_save_upload(job.content, progress=job.progress)
+            job.duplicates = len(self.model.duplicates(job.output))
+            job.state = 'done'
+        except Cancelled:
+            job.state = 'cancelled'
+        except Exception as e:
+            job.error = str(e)
+            job.state = 'failed'
+        finally:
+            # The bytes of a large export are not needed any more
+            job.content = None
+            job.store()
+        REGISTRY.observe('expenses_upload_seconds', time.perf_counter() - start,
+                         help='Time from starting an upload job until it finished')
+        REGISTRY.inc('expenses_upload_jobs_total', help='Upload jobs by outcome', state=job.state)
+
+
+def _alive(pid):
+    """Whether a process of this machine is still running"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (OSError, TypeError):
+        pass
+    return True
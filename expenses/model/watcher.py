@@ -0,0 +1,87 @@
+"""Background thread picking up CSVs that other programs write into the csv directory.
+
+Waits for inotify events if inotify_simple is installed, otherwise polls, and
+in both cases compares the stamps of the CSVs with the files of the model. A
+new or changed file is only ingested once its stamp held still for a moment,
+so a file that is still being copied is not parsed half written. Edits of the
+category rules are applied here too, off the threads serving requests.
+"""
+import threading
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+from ..metrics import REGISTRY
+
+
+# Seconds a changed file's stamp has to stay the same before it is parsed
+SETTLE_DELAY = 0.5
+
+
+class Watcher(threading.Thread):
+    def __init__(self, model, interval=2.0):
+        """interval is the seconds between polls, with inotify between checks without events"""
+        super().__init__(name='expenses-watcher', daemon=True)
+        self.model = model
+        self.interval = interval
+        self._stop_event = threading.Event()
+        # Stamps of files that could not be read, tried again once they change
+        self._failed = {}
+        self._inotify = None
+        if INotify is not None:
+            try:
+                self._inotify = INotify()
+                self._inotify.add_watch(model.csv_dir, flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM
+                                        | flags.DELETE | flags.CREATE)
+            except OSError as e:
+                # Out of watches, or a file system without inotify support
+                print(f"Polling {model.csv_dir} every {interval}s, inotify failed: {e}")
+                self._inotify = None
+
+    def stop(self):
+        """End the thread after its current check, within interval seconds"""
+        self._stop_event.set()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self._wait()
+            if self._stop_event.is_set():
+                break
+            try:
+                self.check()
+            except Exception as e:
+                # The thread has to survive whatever the sync job does to the directory
+                print(f"Watching {self.model.csv_dir} failed: {e}")
+        if self._inotify is not None:
+            self._inotify.close()
+
+    def _wait(self):
+        if self._inotify is None:
+            self._stop_event.wait(self.interval)
+            return
+        # Events only say that something happened, the stamps are compared either way
+        self._inotify.read(timeout=int(self.interval * 1000), read_delay=50)
+
+    def check(self):
+        """Ingest the files changed since the last check whose stamps settled, returns them
+
+        The category rules are applied again first if they were edited, see Model.reload_categories.
+        """
+        self.model.reload_categories()
+        changed, removed = self.model.changes()
+        changed = {f: stamp for f, stamp in changed.items() if self._failed.get(f) != stamp}
+        if not changed and not removed:
+            return {}
+        if changed:
+            self._stop_event.wait(SETTLE_DELAY)
+            again, _ = self.model.changes()
+            # Still being written, the next check looks at them again
+            changed = {f: stamp for f, stamp in changed.items() if again.get(f) == stamp}
+        REGISTRY.inc('expenses_watcher_checks_total', help='Directory changes the watcher acted on')
+        failed = self.model.ingest(changed, removed)
+        for csv_file in list(changed) + list(removed):
+            self._failed.pop(csv_file, None)
+        self._failed.update({f: changed[f] for f in failed})
+        return changed
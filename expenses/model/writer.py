@@ -0,0 +1,116 @@
+"""Minimal writes into bank exports, leaving the rest of the file as the bank wrote it.
+
+The model never writes a CSV from its parsed frames: those lost the preamble, the rows the
+reader skipped and the 'Ausgleich' rows that were merged into one, and amounts or dates
+that did not parse. Entries are appended as rows of text and edited cells patched into the
+rows that hold them, every other byte of the file stays the same.
+"""
+import codecs
+import csv
+import io
+import os
+
+from . import reader
+
+
+def _layout(path, fmt):
+    """(line ending, whether fields are quoted, whether the last line is terminated) of a CSV"""
+    text, _ = reader._decode_sample(reader._read_sample(path))
+    lines = text.split('\n')
+    header = lines[fmt.skiprows] if fmt.columns is not None and fmt.skiprows < len(lines) else ''
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(size - 1, 0))
+        terminated = size == 0 or f.read() == b'\n'
+    return ('\r\n' if '\r\n' in text else '\n'), header.startswith('"'), terminated
+
+
+def _encoding(fmt):
+    # The byte order mark only starts a file
+    return 'utf-8' if fmt.encoding == 'utf-8-sig' else fmt.encoding
+
+
+def _format(fields, delimiter, quoted, newline=''):
+    buffer = io.StringIO()
+    csv.writer(buffer, delimiter=delimiter, quotechar='"', lineterminator=newline,
+               quoting=csv.QUOTE_ALL if quoted else csv.QUOTE_MINIMAL).writerow(fields)
+    return buffer.getvalue()
+
+
+def format_rows(path, rows, columns=None):
+    """The bytes appending rows, {column: text}, to the CSV at path, in its delimiter, quoting and encoding
+
+    Columns the file does not have are left out, columns is the header of files without a
+    known one. Raises UnicodeEncodeError if a value cannot be stored in the file's encoding.
+    """
+    fmt = reader.sniff(path)
+    columns = fmt.columns or columns or []
+    newline, quoted, terminated = _layout(path, fmt)
+    text = ''.join(_format([row.get(column, '') for column in columns], fmt.delimiter, quoted, newline)
+                   for row in rows)
+    return ((newline if not terminated else '') + text).encode(_encoding(fmt))
+
+
+def append_rows(path, rows, columns=None):
+    """Append rows to the CSV at path and wait until they are on disk, see format_rows"""
+    data = format_rows(path, rows, columns)
+    with open(path, 'ab') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def patch_rows(path, changes):
+    """Set cells of the data rows of the CSV at path, returns the number of rows changed
+
+    changes maps the number of a data row to {column: new text}; data rows are counted like
+    the reader reads them, rows without a field per column and empty rows are not counted.
+    Only rows that change are written again, in the quoting of the row; the file is replaced
+    atomically. Columns the file does not have are left out.
+    """
+    fmt = reader.sniff(path)
+    if fmt.columns is None or not changes:
+        return 0
+    with open(path, 'rb') as f:
+        content = f.read()
+    bom = codecs.BOM_UTF8 if content.startswith(codecs.BOM_UTF8) else b''
+    text = content.decode(fmt.encoding)
+    lines = io.StringIO(text, newline='').readlines()
+    # The preamble and header stay as they are, a row may span lines inside quotes
+    output = lines[:fmt.skiprows + 1]
+    records, pending = [], ''
+    for line in lines[fmt.skiprows + 1:]:
+        pending += line
+        if pending.count('"') % 2 == 0:
+            records.append(pending)
+            pending = ''
+    if pending:
+        records.append(pending)
+    positions = {column: position for position, column in enumerate(fmt.columns)}
+    number = 0
+    changed = 0
+    for record in records:
+        body = record.rstrip('\r\n')
+        if '"' in body:
+            fields = next(csv.reader(io.StringIO(body, newline=''), delimiter=fmt.delimiter, quotechar='"'), [])
+        else:
+            fields = body.split(fmt.delimiter)
+        if len(fields) == len(fmt.columns) and any(fields):
+            cells = {positions[column]: value for column, value in changes.get(number, {}).items()
+                     if column in positions and value != fields[positions[column]]}
+            if cells:
+                for position, value in cells.items():
+                    fields[position] = value
+                record = _format(fields, fmt.delimiter, body.startswith('"')) + record[len(body):]
+                changed += 1
+            number += 1
+        output.append(record)
+    if changed:
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(bom + ''.join(output).encode(_encoding(fmt)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    return changed
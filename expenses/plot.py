@@ -1,38 +1,63 @@
 import pandas as pd
-import matplotlib
-matplotlib.use('Agg')  # Use a non-GUI backend for file output
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+
+from .model.model import Model
 
 
 class Plot:
-    def __init__(self, csv_file):
+    def __init__(self, csv_file=None, data=None, store=None):
+        """Plot a classified CSV, read like the dashboard reads it, or a frame that was loaded already
+
+        Figures are built with the object oriented API, without pyplot and its global
+        state, so plots can be rendered from several threads or worker processes.
+        """
         self.csv_file = csv_file
-        self.data = pd.read_csv(csv_file)
+        self.data = data if data is not None else Model.read_file(csv_file, store)
 
-    def plot(self):
-        df = self.data[self.data['Betrag (€)'] < 0].copy()
-        df['Betrag (€)'] = df['Betrag (€)'].abs()
-        category_sums = df.groupby('Kategorie')['Betrag (€)'].sum()
+    def category_sums(self):
+        """Expenses per category in euros, largest first"""
+        amounts = self.data['Betrag (€)']
+        expenses = self.data[amounts < 0]
+        if 'Kategorie' not in expenses.columns:
+            return pd.Series([], dtype=float)
+        # Amounts are in cents, see schema.py
+        sums = -expenses.groupby('Kategorie', observed=True)['Betrag (€)'].sum()
+        if pd.api.types.is_integer_dtype(amounts):
+            sums = sums / 100
+        return sums[sums > 0].sort_values(ascending=False)
+
+    def plot(self, ax):
+        category_sums = self.category_sums()
+        if category_sums.empty:
+            ax.text(0.5, 0.5, 'No expenses', ha='center', va='center')
+            ax.set_axis_off()
+            return ax
         def make_autopct(values):
             def my_autopct(pct):
                 total = sum(values)
                 val = int(round(pct * total / 100.0))
                 return f'{val} €'
             return my_autopct
-        return category_sums.plot.pie(autopct=make_autopct(category_sums), figsize=(8, 8), ylabel='')
-    
+        ax.pie(category_sums, labels=category_sums.index, autopct=make_autopct(category_sums))
+        return ax
+
+    def figure(self, title='Total Amount per Category'):
+        fig = Figure(figsize=(8, 8))
+        ax = self.plot(fig.add_subplot())
+        ax.set_title(title)
+        return fig
+
     def show_plot(self):
-        ax = self.plot()
-        plt.title('Total Amount per Category')
+        # Only showing a window needs pyplot and a GUI backend
+        import matplotlib.pyplot as plt
+        fig = plt.figure(figsize=(8, 8))
+        self.plot(fig.add_subplot()).set_title('Total Amount per Category')
         plt.show()
 
-    def save_plot(self, output_file):
-        ax = self.plot()
-        plt.title('Total Amount per Category')
-        plt.savefig(output_file)
-        plt.close()
-        
-        
+    def save_plot(self, output_file, title='Total Amount per Category'):
+        self.figure(title).savefig(output_file)
+
+
 if __name__ == "__main__":
     plotter = Plot("test_output.csv")
     plotter.show_plot()
@@ -0,0 +1,136 @@
+"""Static month-end reports, a chart of the expenses per category for every month of every classified CSV.
+
+    python -m expenses.report data reports --format png pdf
+
+Each CSV is one account's export, its reports go to <output_dir>/<csv name>/<YYYY-MM>.<format>.
+Files are rendered in parallel by a pool of worker processes. A worker reads its file the
+way the dashboard does, from the sidecar if it is up to date, and draws with the object
+oriented matplotlib API, so nothing is shared between the figures. The stamp of the CSV
+the reports were rendered from is kept next to them, files that did not change since
+are skipped.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .model.model import Model
+from .model.store import SidecarStore
+from .plot import Plot
+
+
+FORMATS = ['png', 'pdf']
+# Written after all reports of a file, see up_to_date
+STAMP_FILE = 'report.json'
+
+
+def report_dir(output_dir, csv_file):
+    return os.path.join(output_dir, os.path.splitext(os.path.basename(csv_file))[0])
+
+
+def _stamp(path):
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def up_to_date(csv_file, output_dir, formats):
+    """Whether the reports of csv_file were rendered from its current content, in all formats"""
+    directory = report_dir(output_dir, csv_file)
+    try:
+        with open(os.path.join(directory, STAMP_FILE), encoding='utf-8') as f:
+            rendered = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if rendered.get('stamp') != _stamp(csv_file) or not set(formats) <= set(rendered.get('formats', [])):
+        return False
+    return all(os.path.exists(os.path.join(directory, name)) for name in rendered.get('outputs', []))
+
+
+def render_file(csv_file, output_dir, formats):
+    """Render the reports of one file in a worker, returns (reports written, seconds)"""
+    start = time.perf_counter()
+    stamp = _stamp(csv_file)
+    data = Model.read_file(csv_file, SidecarStore(os.path.dirname(csv_file)))
+    directory = report_dir(output_dir, csv_file)
+    os.makedirs(directory, exist_ok=True)
+    outputs = []
+    if 'Buchungsdatum' in data.columns and len(data):
+        months = data['Buchungsdatum'].dt.to_period('M')
+        for month, rows in data.groupby(months, sort=True):
+            title = f"{os.path.basename(csv_file)}: {month.strftime('%B %Y')}"
+            fig = Plot(csv_file, data=rows).figure(title)
+            for fmt in formats:
+                name = f"{month}.{fmt}"
+                # Written under a temporary name, a report is either complete or missing
+                tmp = os.path.join(directory, f".{name}.{os.getpid()}.tmp")
+                fig.savefig(tmp, format=fmt)
+                os.replace(tmp, os.path.join(directory, name))
+                outputs.append(name)
+    # Reports of the previous run that are out of date now, of months the file no longer has or other formats
+    previous = os.path.join(directory, STAMP_FILE)
+    try:
+        with open(previous, encoding='utf-8') as f:
+            stale = set(json.load(f).get('outputs', [])) - set(outputs)
+    except (OSError, ValueError):
+        stale = set()
+    for name in stale:
+        if os.path.exists(os.path.join(directory, name)):
+            os.remove(os.path.join(directory, name))
+    tmp = f"{previous}.{os.getpid()}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump({'stamp': stamp, 'formats': list(formats), 'outputs': outputs}, f)
+    os.replace(tmp, previous)
+    return len(outputs), time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render a report per month of every classified CSV.")
+    parser.add_argument("csv_dir", help="Directory with the classified CSV files")
+    parser.add_argument("output_dir", help="Directory the reports are written to")
+    parser.add_argument("--format", nargs='+', choices=FORMATS, default=['png'], dest='formats',
+                        help="Formats of the reports (default: png)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Number of worker processes rendering files in parallel (default: all cores)")
+    parser.add_argument("--force", action="store_true", help="Render the reports of files that did not change, too")
+    args = parser.parse_args()
+
+    csv_files = sorted(glob.glob(os.path.join(args.csv_dir, "*.csv")))
+    jobs = [csv_file for csv_file in csv_files
+            if args.force or not up_to_date(csv_file, args.output_dir, args.formats)]
+    skipped = len(csv_files) - len(jobs)
+
+    start = time.perf_counter()
+    timings = {}
+    if args.workers <= 1 or len(jobs) <= 1:
+        for csv_file in jobs:
+            print(f"Rendering reports of {csv_file}")
+            try:
+                timings[csv_file] = render_file(csv_file, args.output_dir, args.formats)
+            except Exception as e:
+                print(f"Failed to render {csv_file}: {e}", file=sys.stderr)
+    else:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            futures = {}
+            for csv_file in jobs:
+                print(f"Rendering reports of {csv_file}")
+                futures[pool.submit(render_file, csv_file, args.output_dir, args.formats)] = csv_file
+            for future in as_completed(futures):
+                try:
+                    timings[futures[future]] = future.result()
+                except Exception as e:
+                    print(f"Failed to render {futures[future]}: {e}", file=sys.stderr)
+
+    if timings:
+        print(f"\n{'File':<50} {'Reports':>10} {'Seconds':>10}")
+        for csv_file, (reports, seconds) in sorted(timings.items()):
+            print(f"{os.path.basename(csv_file):<50} {reports:>10} {seconds:>10.2f}")
+        total_reports = sum(reports for reports, _ in timings.values())
+        print(f"{'Total':<50} {total_reports:>10} {time.perf_counter() - start:>10.2f}")
+    print(f"{skipped} of {len(csv_files)} files were up to date")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""Size-bounded cache of rendered tab layouts."""
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Dash serves callbacks from several threads
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value of key and mark it as recently used, None on a miss"""
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def invalidate(self, name):
+        """Drop every entry rendered for name, whatever its version"""
+        with self._lock:
+            for key in [key for key in self._items if key[0] == name]:
+                del self._items[key]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
@@ -2,16 +2,62 @@ import dash
 from dash import dcc, html, Input, Output, dash_table
 import pandas as pd
 import plotly.express as px
+import math
 import os
 
+from ..model.model import DETAIL_COLUMNS
+from ..model import schema
+from .cache import LRUCache
+
+
+ALL_TIME = '__all__'
+# How often pages ask whether files were added, changed or removed meanwhile
+REFRESH_INTERVAL_MS = 3000
+# How often a page polls the progress of its uploads while they run
+UPLOAD_POLL_MS = 500
+# Files up to this many rows send their drill-downs to the browser, larger ones are paged by the server
+CLIENT_DETAILS_ROWS = 20000
+# Fields of the "Add New Entry" form, (column, label, placeholder)
+ENTRY_FIELDS = [
+    ('Buchungsdatum', 'Buchungsdatum', 'DD.MM.YY'),
+    ('Wertstellung', 'Wertstellung', 'DD.MM.YY'),
+    ('Verwendungszweck', 'Verwendungszweck', ''),
+    ('Betrag (€)', 'Betrag (€)', '-12,50'),
+    ('Zahlungspflichtige*r', 'Zahlungspflichtige*r', 'optional'),
+    ('Zahlungsempfänger*in', 'Zahlungsempfänger*in', 'optional'),
+]
+
 
 class View:
-    def __init__(self, model):
+    def __init__(self, model, cache_size=32):
         self.model = model
+        # Rendered tab layouts keyed by (tab, data version)
+        self.cache = LRUCache(cache_size)
+
+    def render(self, selected_csv):
+        """Return the layout of a tab, only building figures when the tab's data changed"""
+        if selected_csv == ALL_TIME:
+            version = tuple(self.model.version(csv_file) for csv_file in self.model.csv_files)
+        else:
+            version = self.model.version(selected_csv)
+        layout = self.cache.get((selected_csv, version))
+        if layout is None:
+            # Renders of older versions of this tab can never be hit again
+            self.cache.invalidate(selected_csv)
+            layout = self.all_time_tab() if selected_csv == ALL_TIME else self.tab(selected_csv)
+            self.cache.put((selected_csv, version), layout)
+        return layout
+
+    def tabs(self):
+        """One tab per CSV file plus the 'All time' tab over the whole ledger"""
+        return [dcc.Tab(label="All time", value=ALL_TIME)] + [
+            dcc.Tab(label=" ".join(os.path.basename(csv_file).split("_")[:2]), value=csv_file)
+            for csv_file in self.model.csv_files
+        ]
 
     def main(self):
         csv_files = self.model.csv_files
-        tabs = [dcc.Tab(label=" ".join(os.path.basename(csv_file).split("_")[:2]),value=csv_file) for csv_file in csv_files]
+        tabs = self.tabs()
 
         return html.Div([
             html.H1("Expense Overview"),
@@ -20,7 +66,7 @@ class View:
                     id='upload-csv',
                     children=html.Div([
                         'Drag and Drop or ',
-                        html.A('Select a CSV File')
+                        html.A('Select CSV Files')
                     ]),
                     style={
                         'width': '100%',
@@ -32,22 +78,81 @@ class View:
                         'textAlign': 'center',
                         'margin': '10px 0'
                     },
-                    multiple=False
+                    multiple=True
                 ),
                 html.Div(id='upload-output'),
+                dcc.Interval(id='upload-interval', interval=UPLOAD_POLL_MS, disabled=True),
+                # Finished uploads whose file the page already opened
+                dcc.Store(id='upload-seen', data=[]),
             ]),
+            self.entry_form(),
             dcc.Tabs(
                 id='csv-tabs',
                 value=list(csv_files)[-1] if csv_files else None,
                 children=tabs
             ),
-            html.Div(id='tab-content')
+            html.Div(id='tab-content'),
+            # Files the model listed when the page was built, see Controller.refresh_files
+            dcc.Store(id='files-generation', data=self.model.generation),
+            dcc.Interval(id='refresh-interval', interval=REFRESH_INTERVAL_MS),
         ])
     
+    def upload_jobs(self, jobs):
+        """Progress of queued and recent uploads, running ones with a button to cancel them"""
+        rows = []
+        for job in jobs:
+            name = job.filename or f"Upload {job.id}"
+            if job.state == 'done':
+                message = f'{name}: saved as {os.path.basename(job.output)}'
+                if job.duplicates:
+                    message += f', {job.duplicates} bookings already in other files are only counted there'
+                rows.append(html.P(message, style={'color': 'green'}))
+            elif job.state == 'failed':
+                rows.append(html.P(f'Error processing {name}: {job.error}', style={'color': 'red'}))
+            elif job.state == 'cancelled':
+                rows.append(html.P(f'{name}: cancelled', style={'color': 'gray'}))
+            else:
+                if job.state == 'classifying':
+                    status = f'{job.rows} rows parsed, {job.classified} classified'
+                elif job.state == 'writing':
+                    status = f'writing {job.rows} rows'
+                else:
+                    status = job.state
+                rows.append(html.Div([
+                    html.Span(f'{name}: {status} '),
+                    html.Button('Cancel', id={'type': 'cancel-upload', 'job': job.id}, n_clicks=0),
+                ]))
+        return html.Div(rows)
+
+    def entry_form(self):
+        """Form adding a single booking to the selected file"""
+        field_style = {'display': 'flex', 'flexDirection': 'column', 'margin': '0 10px 10px 0'}
+        fields = [
+            html.Div([html.Label(label), dcc.Input(id={'type': 'entry-field', 'column': column}, type='text',
+                                                   placeholder=placeholder, debounce=True)], style=field_style)
+            for column, label, placeholder in ENTRY_FIELDS
+        ]
+        categories = list(dict.fromkeys(list(self.model.classifier.categories) + ['sonstiges']))
+        fields += [
+            html.Div([html.Label('Umsatztyp'), dcc.Dropdown(
+                id={'type': 'entry-field', 'column': 'Umsatztyp'}, options=['Eingang', 'Ausgang'],
+                style={'width': '150px'})], style=field_style),
+            html.Div([html.Label('Kategorie'), dcc.Dropdown(
+                id={'type': 'entry-field', 'column': 'Kategorie'}, options=categories,
+                style={'width': '200px'})], style=field_style),
+        ]
+        return html.Details([
+            html.Summary("Add New Entry"),
+            html.Div(fields, style={'display': 'flex', 'flexWrap': 'wrap', 'alignItems': 'flex-end'}),
+            html.Button("Add Entry", id='add-entry-button', n_clicks=0),
+            html.Div(id='add-entry-output'),
+        ], style={'margin': '10px 0'})
+
     def tab(self, selected_csv):
-        df_expenses = self.model.expenses(selected_csv).copy(deep=False)
-        df_expenses['Betrag (€)'] = df_expenses['Betrag (€)'].abs()
-        date_span = self.model.get_date_span(df_expenses)
+        category_totals = self.model.category_totals(selected_csv)
+        df_expenses = pd.DataFrame({'Kategorie': category_totals.index,
+                                    'Betrag (€)': schema.to_euros(category_totals.to_numpy())})
+        date_span = self.model.date_span(selected_csv)
         pie_fig = px.pie(
             df_expenses,
             names='Kategorie',
@@ -60,10 +165,9 @@ class View:
             hovertemplate='%{label}: %{value:.2f} €<extra></extra>',
             
         )
-        df = self.model.df(selected_csv).copy()
-        df['Type'] = df['Betrag (€)'].apply(lambda x: 'Income' if x >= 0 else 'Expense')
-        df['Betrag (€)'] = df['Betrag (€)'].abs()
-        agg_type = df.groupby(['Type'])['Betrag (€)'].sum().reset_index()
+        type_totals = self.model.type_totals(selected_csv)
+        agg_type = pd.DataFrame({'Type': list(type_totals),
+                                 'Betrag (€)': [schema.to_euros(total) for total in type_totals.values()]})
 
         bar_fig = px.bar(agg_type, x='Type', y='Betrag (€)',title='Income vs Expense', color='Type',
                          labels={'Betrag (€)': 'Total Amount (€)', 'Type': 'Income/Expense'},
@@ -72,7 +176,6 @@ class View:
         bar_fig = bar_fig.update_traces(
             hovertemplate='Type: %{x}<br>Total: %{y:.2f} €<extra></extra>'
         )
-        df_details = df[['Zahlungsempfänger*in', 'Verwendungszweck', 'Betrag (€)', 'Buchungsdatum', 'Kategorie']]
         return html.Div([
             html.H3(f"{date_span}", style={"color": "#444"}),
             html.Div([
@@ -80,29 +183,77 @@ class View:
                 dcc.Graph(id='category-pie-2', figure=pie_fig)
                 ], style={'display': 'flex', 'justifyContent': 'space-around'}),
             html.H2(id='details-title', children="Click a category to see details"),
-            dash_table.DataTable(
-                id='details-table',
-                columns=[{"name": col, "id": col} for col in df_details.columns],
-                data=df_details.to_dict('records'),
-                page_size=10,
-                style_table={'overflowX': 'auto'},
-            )
+            *self.details(selected_csv),
         ])
-        
-    def detailed_expenses_in_category(self, selected_csv, category):
-        df = self.model.expense_in_category(selected_csv, category)
-        df = df[['Zahlungsempfänger*in', 'Verwendungszweck', 'Betrag (€)', 'Buchungsdatum', 'Kategorie']]
-        df = df.sort_values(by='Betrag (€)')
-        return f"Details for category: {category}", df.to_dict('records')
-    
-    def detailed_expenses(self, selected_csv):
-        df = self.model.expenses(selected_csv)
-        df = df[['Zahlungsempfänger*in', 'Verwendungszweck', 'Betrag (€)', 'Buchungsdatum', 'Kategorie']]
-        df = df.sort_values(by='Betrag (€)')
-        return f"Expenses", df.to_dict('records')
-    
-    def detailed_income(self, selected_csv):
-        df = self.model.income(selected_csv)
-        df = df[['Zahlungspflichtige*r', 'Verwendungszweck', 'Betrag (€)', 'Buchungsdatum', 'Kategorie']]
-        df = df.sort_values(by='Betrag (€)')
-        return f"Income", df.to_dict('records')
+
+    def details(self, selected_csv):
+        """Drill-down table of a tab, with the store of the current selection
+
+        Small files ship all drill-downs with the tab and the browser filters and sorts them,
+        clicks never reach the server. Larger files are paged, sorted and filtered on the server.
+        The mode is part of the component ids, so only the callbacks of one mode ever fire.
+        """
+        client = len(self.model.data[selected_csv]) <= CLIENT_DETAILS_ROWS
+        mode = 'client' if client else 'server'
+        components = [dcc.Store(id={'type': 'details-selection', 'mode': mode},
+                                data=self.details_overview(selected_csv)[1])]
+        if client:
+            components.append(dcc.Store(id='details-data', data=self.model.details_dataset(selected_csv)))
+        components.append(dash_table.DataTable(
+            id={'type': 'details-table', 'mode': mode},
+            columns=[{"name": col, "id": col} for col in DETAIL_COLUMNS],
+            data=[],
+            # Filled in by the clientside callback, which also sorts, or one page at a time by the server
+            page_action='native' if client else 'custom',
+            page_current=0,
+            page_size=10,
+            sort_action='custom',
+            sort_mode='single',
+            sort_by=[],
+            filter_action='native' if client else 'custom',
+            filter_query='',
+            style_table={'overflowX': 'auto'},
+        ))
+        return components
+
+    def all_time_tab(self):
+        totals = schema.to_euros(self.model.totals('MS'))
+        first, last = self.model.date_range()
+        if pd.isnull(first):
+            date_span = "Zeitraum unbekannt"
+        else:
+            date_span = f"{first.strftime('%d.%m.%Y')} bis {last.strftime('%d.%m.%Y')}"
+        trend_fig = px.bar(
+            totals.reset_index().melt(id_vars='Datum', var_name='Type', value_name='Betrag (€)'),
+            x='Datum', y='Betrag (€)', color='Type', barmode='group',
+            title='Income vs Expense per Month',
+            labels={'Betrag (€)': 'Total Amount (€)', 'Datum': 'Month', 'Type': 'Income/Expense'},
+        ).update_traces(hovertemplate='%{x|%m.%Y}: %{y:.2f} €<extra></extra>')
+        balance = (totals['Income'] - totals['Expense']).cumsum()
+        balance_fig = px.line(
+            x=balance.index, y=balance.to_numpy(), title='Cumulative Balance',
+            labels={'x': 'Month', 'y': 'Balance (€)'}, markers=True,
+        ).update_traces(hovertemplate='%{x|%m.%Y}: %{y:.2f} €<extra></extra>')
+        categories = schema.to_euros(self.model.category_totals_over_time('MS'))
+        category_fig = px.area(
+            categories.reset_index().melt(id_vars='Datum', var_name='Kategorie', value_name='Betrag (€)'),
+            x='Datum', y='Betrag (€)', color='Kategorie', title='Expenses by Category per Month',
+            labels={'Betrag (€)': 'Total Amount (€)', 'Datum': 'Month'},
+        )
+        return html.Div([
+            html.H3(f"{date_span}", style={"color": "#444"}),
+            dcc.Graph(id='trend-fig', figure=trend_fig),
+            dcc.Graph(id='balance-fig', figure=balance_fig),
+            dcc.Graph(id='category-trend-fig', figure=category_fig),
+        ])
+
+    def details_overview(self, selected_csv):
+        return "Click a category to see details", {'csv': selected_csv, 'kind': 'all'}
+
+    def details_page(self, selection, page_current, page_size, sort_by=(), filters=()):
+        """Return records, page count and columns of one page of the details table"""
+        df, total = self.model.details_page(
+            selection['csv'], selection['kind'], selection.get('category'),
+            page_current=page_current, page_size=page_size, sort_by=sort_by, filters=filters)
+        page_count = max(1, math.ceil(total / page_size))
+        return schema.to_records(df), page_count, [{"name": col, "id": col} for col in df.columns]
@@ -2,31 +2,95 @@ import os
 import argparse
 import sys
 import glob
-import yaml
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 
-from expenses.classifier import Classifier
+from expenses.classifier import Classifier, load_categories
+from expenses.llm import DEFAULT_MODEL, LLMClassifier
+
+# One classifier per worker process, created by _init_worker
+_classifier = None
+
+
+def _init_worker(categories, cache_path, llm):
+    global _classifier
+    fallback = LLMClassifier(categories, **llm) if llm is not None else None
+    _classifier = Classifier(categories=categories, cache_path=cache_path, fallback=fallback)
+
+
+def _classify(csv_file, classified_file, chunksize):
+    """Classify one file in a worker, returns (rows, seconds)"""
+    start = time.perf_counter()
+    rows = _classifier.classify_file(csv_file, classified_file, chunksize=chunksize)
+    return rows, time.perf_counter() - start
+
 
 def main():
     parser = argparse.ArgumentParser(description="Classify transactions and plot results.")
     parser.add_argument("input_folder", help="Path to input folder containing CSV files")
     parser.add_argument("output_path", help="Path to output directory", default=".")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Number of worker processes classifying files in parallel (default: all cores)")
+    parser.add_argument("--chunksize", type=int, default=100_000,
+                        help="Rows read, classified and written at a time per file (default: 100000)")
+    parser.add_argument("--cache", default=None,
+                        help="SQLite file remembering the category of every text classified before "
+                             "(default: <output_path>/.cache/classifications.sqlite)")
+    parser.add_argument("--no-cache", action="store_true", help="Classify every text again")
+    parser.add_argument("--llm", action="store_true",
+                        help="Ask an LLM about texts no keyword matches, implied by --llm-url")
+    parser.add_argument("--llm-url", default=None,
+                        help="Chat completions compatible endpoint (default: the OpenAI API)")
+    parser.add_argument("--llm-model", default=DEFAULT_MODEL,
+                        help=f"Model the LLM fallback asks (default: {DEFAULT_MODEL})")
+    parser.add_argument("--llm-concurrency", type=int, default=8,
+                        help="Prompts in flight at a time per worker (default: 8)")
     args = parser.parse_args()
-    
+
     os.makedirs(args.output_path, exist_ok=True)
-    with open("config/categories.yaml", "r") as f:
-        categories_yaml = yaml.safe_load(f)
-    categories_list = categories_yaml.get("Categories", [])
-    # Convert list of dicts to dict with category name as key
-    categories = {cat["name"]: {"keywords": cat["keywords"]} for cat in categories_list}
-    classifier = Classifier(categories=categories)
+    categories = load_categories()
+
+    cache_path = None
+    if not args.no_cache:
+        cache_path = args.cache or os.path.join(args.output_path, ".cache", "classifications.sqlite")
+    llm = None
+    if args.llm or args.llm_url:
+        llm = {"base_url": args.llm_url, "model": args.llm_model, "concurrency": args.llm_concurrency}
 
     csv_files = glob.glob(os.path.join(args.input_folder, "*.csv"))
+    jobs = []
     for csv_file in csv_files:
         base_name = os.path.splitext(os.path.basename(csv_file))[0]
         classified_file = os.path.join(args.output_path, f"{base_name}_classified.csv")
-        print(f"Classifying {csv_file} and saving to {classified_file}")
-        classifier.classify_file(csv_file, classified_file)
+        jobs.append((csv_file, classified_file))
+
+    start = time.perf_counter()
+    timings = {}
+    if args.workers <= 1 or len(jobs) <= 1:
+        _init_worker(categories, cache_path, llm)
+        for csv_file, classified_file in jobs:
+            print(f"Classifying {csv_file} and saving to {classified_file}")
+            timings[csv_file] = _classify(csv_file, classified_file, args.chunksize)
+    else:
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker,
+                                 initargs=(categories, cache_path, llm)) as pool:
+            futures = {}
+            for csv_file, classified_file in jobs:
+                print(f"Classifying {csv_file} and saving to {classified_file}")
+                futures[pool.submit(_classify, csv_file, classified_file, args.chunksize)] = csv_file
+            for future in as_completed(futures):
+                try:
+                    timings[futures[future]] = future.result()
+                except Exception as e:
+                    print(f"Failed to classify {futures[future]}: {e}", file=sys.stderr)
+
+    if timings:
+        print(f"\n{'File':<50} {'Rows':>10} {'Seconds':>10}")
+        for csv_file, (rows, seconds) in sorted(timings.items()):
+            print(f"{os.path.basename(csv_file):<50} {rows:>10} {seconds:>10.2f}")
+        total_rows = sum(rows for rows, _ in timings.values())
+        print(f"{'Total':<50} {total_rows:>10} {time.perf_counter() - start:>10.2f}")
 
 
 if __name__ == "__main__":
@@ -38,6 +38,7 @@ setup(
         "console_scripts": [
             "expenses-classify=expenses.classifier:main",
             "expenses-app=app:main",
+            "expenses-report=expenses.report:main",
         ],
     },
 )
@@ -0,0 +1,37 @@
+"""WSGI entry point for serving the dashboard from several worker processes, e.g.
+
+    EXPENSES_CSV_DIR=data gunicorn --workers 4 --bind 0.0.0.0:8050 wsgi:server
+
+Every worker builds its own model of the directory. They share the sidecars, which
+are memory-mapped, and a version counter bumped on every write, so an upload or a
+new entry in one worker shows up in the others with their next request.
+
+Options come from the environment, as there is no command line:
+
+    EXPENSES_CSV_DIR        directory with the classified CSVs (default: data)
+    EXPENSES_MAX_MEMORY_MB  memory budget of each worker, like --max-memory-mb
+    EXPENSES_LLM_URL        chat completions endpoint of the LLM fallback, like --llm-url
+    EXPENSES_LLM_MODEL      model the LLM fallback asks, like --llm-model
+    EXPENSES_WATCH_INTERVAL seconds between checks for CSVs written by other programs, like --watch-interval
+    EXPENSES_PROFILE_DIR    dump the profiles of slow callbacks here, like --profile-dir
+"""
+import os
+
+from app import create_app
+from expenses.llm import DEFAULT_MODEL
+
+
+csv_dir = os.environ.get('EXPENSES_CSV_DIR', 'data')
+os.makedirs(csv_dir, exist_ok=True)
+max_memory_mb = os.environ.get('EXPENSES_MAX_MEMORY_MB')
+llm_url = os.environ.get('EXPENSES_LLM_URL')
+
+app = create_app(
+    csv_dir,
+    llm={'base_url': llm_url, 'model': os.environ.get('EXPENSES_LLM_MODEL', DEFAULT_MODEL)} if llm_url else None,
+    max_memory_mb=float(max_memory_mb) if max_memory_mb else None,
+    shared=True,
+    watch_interval=float(os.environ.get('EXPENSES_WATCH_INTERVAL', 2.0)),
+    profile_dir=os.environ.get('EXPENSES_PROFILE_DIR'),
+)
+server = app.server